@@ -1,12 +1,20 @@
+import contextlib
+import datetime
+import functools
+import html
 import logging
+import random
+import threading
 import uuid
 import qrcode
 import io
 import re
 import asyncio
+import concurrent.futures
 import time
 import os
 import json
+import orjson
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputFile, KeyboardButton, Bot
 from telegram.ext import (
     Application,
@@ -16,31 +24,49 @@ from telegram.ext import (
     ConversationHandler,
     filters,
     ContextTypes,
-    ApplicationBuilder
+    ApplicationBuilder,
+    AIORateLimiter
 )
+from telegram.error import BadRequest, RetryAfter, TimedOut
 from dotenv import load_dotenv
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from PIL import Image
 from pyzbar.pyzbar import decode
-from logging.handlers import RotatingFileHandler
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 
 # Базовая директория
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Настройка логирования с ротацией
-handler = RotatingFileHandler(
+# Настройка логирования с ротацией. shouldRollover стандартного
+# обработчика делает stat()/exists() на каждый emit; позиции в уже
+# открытом потоке достаточно для проверки порога
+class _FastRotatingFileHandler(RotatingFileHandler):
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        msg = f"{self.format(record)}\n"
+        return self.stream.tell() + len(msg) >= self.maxBytes
+
+handler = _FastRotatingFileHandler(
     os.path.join(BASE_DIR, 'favor2025.log'),
     maxBytes=5*1024*1024,  # 5 МБ
     backupCount=3
 )
+# Запись в файл уходит через очередь в отдельный поток слушателя,
+# чтобы emit на горячем пути не ждал файлового ввода-вывода
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
-    handlers=[handler],
+    handlers=[QueueHandler(_log_queue)],
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+_log_listener = QueueListener(_log_queue, handler, respect_handler_level=True)
+_log_listener.start()
 logger = logging.getLogger(__name__)
 
 # Загрузка переменных окружения
@@ -48,88 +74,221 @@ load_dotenv()
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
 CHANNEL_ID = os.getenv('CHANNEL_ID')
-ALLOWED_ADMIN_IDS = set(map(int, os.getenv('ALLOWED_ADMIN_IDS', '').split(','))) if os.getenv('ALLOWED_ADMIN_IDS') else set()
+# Терпимо к пробелам и висячим запятым ("12, 34,"), чтобы опечатка в .env
+# не роняла бота на импорте
+ALLOWED_ADMIN_IDS = frozenset(int(x) for x in re.split(r'[,\s]+', os.getenv('ALLOWED_ADMIN_IDS', '')) if x)
 GOOGLE_SHEETS_KEY = os.getenv('GOOGLE_SHEETS_KEY')
 GOOGLE_CREDENTIALS_JSON = os.getenv('GOOGLE_CREDENTIALS_JSON')
 ORGANIZER_CONTACT = os.getenv('ORGANIZER_CONTACT', '@Organizer')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Новая переменная окружения для Webhook URL
 PORT = int(os.getenv('PORT', 8000))  # Порт для Render, по умолчанию 8000
 
-# Проверка обязательных переменных
-if not TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN не задан в .env файле")
-    raise ValueError("TELEGRAM_BOT_TOKEN не задан в .env файле")
-if not ADMIN_PASSWORD:
-    logger.error("ADMIN_PASSWORD не задан в .env файле")
-    raise ValueError("ADMIN_PASSWORD не задан в .env файле")
-if not CHANNEL_ID:
-    logger.error("CHANNEL_ID не задан в .env файле")
-    raise ValueError("CHANNEL_ID не задан в .env файле")
-if not GOOGLE_SHEETS_KEY:
-    logger.error("GOOGLE_SHEETS_KEY не задан в .env файле")
-    raise ValueError("GOOGLE_SHEETS_KEY не задан в .env файле")
-if not GOOGLE_CREDENTIALS_JSON:
-    logger.error("GOOGLE_CREDENTIALS_JSON не задан в переменных окружения")
-    raise ValueError("GOOGLE_CREDENTIALS_JSON не задан в переменных окружения")
-if not WEBHOOK_URL:
-    logger.error("WEBHOOK_URL не задан в .env файле")
-    raise ValueError("WEBHOOK_URL не задан в .env файле")
+# Проверка обязательных переменных одним проходом: все отсутствующие
+# переменные сообщаются сразу, а не по одной на каждый рестарт
+_REQUIRED_ENV = ('TELEGRAM_BOT_TOKEN', 'ADMIN_PASSWORD', 'CHANNEL_ID', 'GOOGLE_SHEETS_KEY', 'GOOGLE_CREDENTIALS_JSON', 'WEBHOOK_URL')
+_missing_env = [k for k in _REQUIRED_ENV if not os.getenv(k)]
+if _missing_env:
+    logger.error(f"Не заданы обязательные переменные окружения: {', '.join(_missing_env)}")
+    raise ValueError(f"Не заданы обязательные переменные окружения: {', '.join(_missing_env)}")
 
 # Путь к фото для команды /start
 START_PHOTO_PATH = os.path.join(BASE_DIR, 'photo.jpg')
-
-# Проверка существования и размера файла photo.jpg
 MAX_PHOTO_SIZE_MB = 5  # Максимальный размер фото в МБ
-if os.path.exists(START_PHOTO_PATH):
-    photo_size_mb = os.path.getsize(START_PHOTO_PATH) / (1024 * 1024)  # Размер в МБ
-    if photo_size_mb > MAX_PHOTO_SIZE_MB:
-        logger.warning(f"Файл photo.jpg слишком большой: {photo_size_mb:.2f} МБ. Максимум: {MAX_PHOTO_SIZE_MB} МБ. Фото не будет отправлено.")
-        START_PHOTO_PATH = None  # Отключаем отправку фото, если файл слишком большой
-else:
-    logger.warning(f"Файл photo.jpg не найден по пути: {START_PHOTO_PATH}. Фото не будет отправлено.")
-    START_PHOTO_PATH = None
+
+# Проверка существования и размера файла photo.jpg; выполняется в startup(),
+# чтобы не тратить syscall-ы на импорт при каждом холодном старте
+def _check_start_photo():
+    global START_PHOTO_PATH
+    if START_PHOTO_PATH and os.path.exists(START_PHOTO_PATH):
+        photo_size_mb = os.path.getsize(START_PHOTO_PATH) / (1024 * 1024)  # Размер в МБ
+        if photo_size_mb > MAX_PHOTO_SIZE_MB:
+            logger.warning(f"Файл photo.jpg слишком большой: {photo_size_mb:.2f} МБ. Максимум: {MAX_PHOTO_SIZE_MB} МБ. Фото не будет отправлено.")
+            START_PHOTO_PATH = None  # Отключаем отправку фото, если файл слишком большой
+    else:
+        logger.warning(f"Файл photo.jpg не найден по пути: {START_PHOTO_PATH}. Фото не будет отправлено.")
+        START_PHOTO_PATH = None
+
+def _retry_delay(attempt, backoff, max_delay):
+    # Джиттер разносит повторные попытки разных процессов/задач во времени,
+    # чтобы не бить по квоте API синхронной волной
+    return min(max_delay, backoff * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+# Общий декоратор повторных попыток с экспоненциальной задержкой и джиттером.
+# Подходит и для корутин, и для блокирующих функций; после последней
+# неудачной попытки исключение пробрасывается вызывающему.
+def retry_with_backoff(retries=3, backoff=2, max_delay=30):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                for attempt in range(retries):
+                    try:
+                        return await func(*args, **kwargs)
+                    except RetryAfter as e:
+                        # Telegram сообщил точное время ожидания (flood control)
+                        logger.warning(f"{func.__name__}: flood control, ждём {e.retry_after} с")
+                        if attempt == retries - 1:
+                            raise
+                        await asyncio.sleep(e.retry_after + random.uniform(0, 0.5))
+                    except TimedOut:
+                        # При таймауте Telegram обычно всё же доставляет сообщение;
+                        # повтор дал бы дубликат
+                        logger.warning(f"{func.__name__}: таймаут, повтор не выполняется во избежание дублей")
+                        return None
+                    except Exception as e:
+                        logger.error(f"{func.__name__} (попытка {attempt+1}/{retries}): {e}")
+                        if attempt == retries - 1:
+                            raise
+                        await asyncio.sleep(_retry_delay(attempt, backoff, max_delay))
+            return async_wrapper
+
+        @functools.wraps(func)
+        def sync_wrapper(*args, **kwargs):
+            for attempt in range(retries):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    logger.error(f"{func.__name__} (попытка {attempt+1}/{retries}): {e}")
+                    if attempt == retries - 1:
+                        raise
+                    time.sleep(_retry_delay(attempt, backoff, max_delay))
+        return sync_wrapper
+    return decorator
 
 # Инициализация Google Sheets с повторными попытками
 scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/spreadsheets']
+# Учётные данные сервисного аккаунта разбираются один раз при импорте,
+# а не на каждую попытку init_google_sheets
+_GOOGLE_CREDS = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(GOOGLE_CREDENTIALS_JSON), scope)
 worksheet = None
 accommodation_worksheet = None
+# Авторизованный клиент gspread создаётся один раз и переживает ретраи:
+# повторная авторизация (TLS + обмен OAuth-токена) нужна только при
+# протухшем токене, о котором позаботится сам gspread через _GOOGLE_CREDS
+_gs_client = None
 
-async def init_google_sheets(retries=3, backoff=2):
+def _get_gs_client():
+    global _gs_client
+    if _gs_client is None:
+        _gs_client = gspread.authorize(_GOOGLE_CREDS)
+    return _gs_client
+
+@retry_with_backoff()
+def _sync_init_google_sheets():
     global worksheet, accommodation_worksheet
-    for attempt in range(retries):
-        try:
-            creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            client = gspread.authorize(creds)
-            spreadsheet = client.open_by_key(GOOGLE_SHEETS_KEY)
-            try:
-                worksheet = spreadsheet.worksheet('Лист1')
-            except gspread.exceptions.WorksheetNotFound:
-                worksheet = spreadsheet.add_worksheet(title='Лист1', rows=100, cols=20)
-                headers = ['registration_id', 'user_id', 'name', 'days', 'arrival_date', 'city', 'nick', 'phone', 'birth_date', 'gender', 'accommodation']
-                worksheet.append_row(headers)
-            try:
-                accommodation_worksheet = spreadsheet.worksheet('Расселение')
-            except gspread.exceptions.WorksheetNotFound:
-                accommodation_worksheet = spreadsheet.add_worksheet(title='Расселение', rows=100, cols=10)
-                headers = [f'Дом {i+1}' for i in range(10)]
-                accommodation_worksheet.append_row(headers)
-            logger.info("Google Sheets инициализирован успешно")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка инициализации Google Sheets (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(backoff * (2 ** attempt))
-            else:
-                logger.error("Не удалось инициализировать Google Sheets после всех попыток")
-                return False
+    client = _get_gs_client()
+    spreadsheet = client.open_by_key(GOOGLE_SHEETS_KEY)
+    try:
+        worksheet = spreadsheet.worksheet('Лист1')
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title='Лист1', rows=100, cols=20)
+        headers = ['registration_id', 'user_id', 'name', 'days', 'arrival_date', 'city', 'nick', 'phone', 'birth_date', 'gender', 'accommodation']
+        worksheet.append_row(headers)
+    try:
+        accommodation_worksheet = spreadsheet.worksheet('Расселение')
+    except gspread.exceptions.WorksheetNotFound:
+        accommodation_worksheet = spreadsheet.add_worksheet(title='Расселение', rows=100, cols=10)
+        headers = [f'Дом {i+1}' for i in range(10)]
+        accommodation_worksheet.append_row(headers)
 
-# Функция для экранировки специальных символов в Markdown
-def escape_markdown(text):
+async def init_google_sheets():
+    try:
+        await asyncio.to_thread(_sync_init_google_sheets)
+        logger.info("Google Sheets инициализирован успешно")
+        return True
+    except Exception:
+        logger.error("Не удалось инициализировать Google Sheets после всех попыток")
+        return False
+
+# Экранировка пользовательского текста для parse_mode='HTML':
+# в отличие от Markdown v1 здесь нет ошибок "can't parse entities"
+# из-за непарных символов в ФИО или никах
+def escape_html(text):
     if not isinstance(text, str):
         text = str(text)
-    special_chars = r'([_*[\]()~`>#+\-=|{}.!])'
-    return re.sub(special_chars, r'\\\1', text)
+    return html.escape(text, quote=False)
+
+# Предкомпилированные шаблоны валидации анкетных полей: связанный
+# .match дешевле обращения в кэш re на каждое сообщение
+_PHONE_MATCH = re.compile(r"^\+?\d{10,15}$").match
+_BIRTH_DATE_MATCH = re.compile(r"^\d{2}\.\d{2}\.\d{4}$").match
+
+# Единый сборщик карточки регистрации: один и тот же 9-строчный блок
+# раньше собирался в пяти местах с повторными вызовами экранировки.
+# Тело без заголовка вынесено отдельно, чтобы пары сообщений
+# (подтверждение + канал) экранировали данные один раз
+def _registration_body(data, days_label="Количество дней"):
+    return "\n".join([
+        f"ФИО: {escape_html(data['name'])}",
+        f"{days_label}: {data['days']}",
+        f"Дата приезда: {data['arrival_date']}",
+        f"Город: {escape_html(data['city'])}",
+        f"Ник: {escape_html(data.get('nick', 'Не указан'))}",
+        f"Телефон: {escape_html(data.get('phone', 'Не указан'))}",
+        f"Дата рождения: {data.get('birth_date', 'Не указана')}",
+        f"Пол: {data.get('gender', 'Не указан')}",
+    ])
+
+def _registration_summary(data, *, title, days_label="Количество дней", footer=""):
+    text = f"{title}\n{_registration_body(data, days_label)}"
+    if footer:
+        text = f"{text}\n{footer}"
+    return text
+
+# Кэш готовых PNG QR-кодов по registration_id: payload неизменен,
+# поэтому кодируем каждый код один раз
+qr_cache = {}
+
+# Переиспользуемый буфер кодирования на поток, чтобы не аллоцировать
+# свежий BytesIO на каждый промах кэша
+_tls = threading.local()
+
+def _render_qr(registration_id):
+    # ECC-L и уменьшенные box_size/border дают ~10x меньше пикселей,
+    # чем дефолт qrcode.make(); версия подбирается минимальной под payload
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=4, border=2)
+    qr.add_data(registration_id)
+    qr.make(fit=True)
+    buf = getattr(_tls, 'qr_buf', None)
+    if buf is None:
+        buf = _tls.qr_buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate()
+    # compress_level=1: QR-PNG крошечный и уходит в Telegram один раз,
+    # агрессивный zlib-проход PIL здесь только тратит CPU
+    qr.make_image().save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()
+
+async def get_qr_png(registration_id):
+    png = qr_cache.get(registration_id)
+    if png is None:
+        png = await asyncio.to_thread(_render_qr, registration_id)
+        qr_cache[registration_id] = png
+    return png
+
+# file_id, который Telegram вернул при первой загрузке QR: повторная отправка
+# по file_id — маленький JSON-запрос вместо multipart-загрузки PNG
+qr_file_id = {}
+
+async def send_qr_photo(message, registration_id, **kwargs):
+    file_id = qr_file_id.get(registration_id)
+    if file_id:
+        try:
+            await _reply_photo_with_retry(message, photo=file_id, **kwargs)
+            return
+        except BadRequest:
+            logger.warning(f"file_id QR-кода недействителен для registration_id={registration_id}, загружаем PNG заново")
+            qr_file_id.pop(registration_id, None)
+    # InputFile поверх неизменяемых байтов: повторная попытка внутри
+    # _reply_photo_with_retry не упирается в сдвинутый курсор BytesIO
+    png = InputFile(await get_qr_png(registration_id), filename=f'{registration_id}.png')
+    msg = await _reply_photo_with_retry(message, photo=png, **kwargs)
+    if msg is not None and msg.photo:
+        qr_file_id[registration_id] = msg.photo[-1].file_id
+
+# Общий ограничитель параллелизма рассылок; лимит должен оставаться
+# <= connection_pool_size приложения
+BROADCAST_SEM = asyncio.Semaphore(20)
 
 # Состояния для ConversationHandler
 NAME, DAYS, ARRIVAL_DATE, CITY, PHONE, BIRTH_DATE, GENDER, ROOM = range(8)
@@ -137,8 +296,14 @@ NAME, DAYS, ARRIVAL_DATE, CITY, PHONE, BIRTH_DATE, GENDER, ROOM = range(8)
 # Глобальные словари для хранения данных
 user_data = {}
 user_registration_ids = {}
+registration_user_ids = {}
+# Номер строки листа 'Лист1' для каждого registration_id; поддерживается
+# при загрузке и сохранении, чтобы точечные операции не перечитывали лист
+rid_to_row = {}
+# registration_id, для которых формат "зелёной строки" уже поставлен в
+# очередь: повторные /check_qr и сканы не плодят дубликаты операций
+_greened_registrations = set()
 registrations = {}
-registered_users = set()
 admin_users = set()
 accommodation_initiated = set()
 
@@ -148,63 +313,151 @@ stats = {
     'checked_in': set()
 }
 
-room_assignments = {i+1: [] for i in range(10)}
+# Алиас канонического множества зарегистрированных: раньше то же самое
+# хранилось вторым набором и оба обновлялись вручную
+registered_users = stats['registered']
+
+room_assignments = {i+1: set() for i in range(10)}
 user_room = {}
 
-# Путь к файлу статистики
+# Путь к файлу статистики (снапшот) и журналу дозаписи
 STATS_FILE = os.path.join(BASE_DIR, 'stats.json')
+STATS_LOG_FILE = os.path.join(BASE_DIR, 'stats.log')
+# После этого числа строк в журнале он сворачивается в снапшот stats.json
+STATS_LOG_COMPACT_THRESHOLD = 1000
 
 # Опции для выбора
 days_options = [1, 2, 3, 4]
 dates = ["03.07.2025", "04.07.2025", "05.07.2025", "06.07.2025"]
 
+# Статичные inline-клавиатуры; их состав не меняется, поэтому объекты
+# собираются один раз при импорте, а не на каждый callback
+DAYS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{days} день: {days*10}$", callback_data=f'days_{days}') for days in [1, 2]],
+    [InlineKeyboardButton(f"{days} дня: {days*10}$", callback_data=f'days_{days}') for days in [3, 4]]
+])
+DATES_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(date, callback_data=f'date_{date}')] for date in dates]
+)
+GENDER_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Мужской", callback_data='gender_Мужской')],
+    [InlineKeyboardButton("Женский", callback_data='gender_Женский')]
+])
+# Дома по полу: одна таблица вместо разбросанных if-веток в выборе
+# и валидации дома
+GENDER_ROOMS = {"Мужской": range(1, 6), "Женский": range(6, 11)}
+ACCOMMODATION_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Да", callback_data='need_accommodation')],
+    [InlineKeyboardButton("Нет", callback_data='no_accommodation')]
+])
+AGREE_KB = InlineKeyboardMarkup([[InlineKeyboardButton("Согласен с правилами", callback_data='agree')]])
+CONFIRM_CLEAR_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Подтвердить", callback_data='confirm_clear')],
+    [InlineKeyboardButton("Отмена", callback_data='cancel_clear')]
+])
+CONFIRM_SLEEP_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Подтвердить", callback_data='confirm_sleep')],
+    [InlineKeyboardButton("Отмена", callback_data='cancel_sleep')]
+])
+
+# Статичные тексты для самых частых кнопок; собираются один раз при импорте
+SCHEDULE_MSG = (
+    "Распорядок дня:\n"
+    "- 08:00 - Завтрак\n"
+    "- 09:00 - Утреннее богослужение\n"
+    "- 11:00 - Семинары и мастер-классы\n"
+    "- 13:00 - Обед\n"
+    "- 14:00 - Свободное время/спорт\n"
+    "- 17:00 - Вечернее богослужение\n"
+    "- 19:00 - Ужин\n"
+    "- 20:00 - Вечерняя программа (концерты, общение)"
+)
+SPEAKERS_MSG = (
+    "Спикеры:\n"
+    "- Иван Петров - пастор, автор книги 'Живи с верой'\n"
+    "- Анна Смирнова - молодежный лидер, спикер TEDx\n"
+    "- Сергей Ковалев - евангелист, миссионер"
+)
+LOCATION_MSG = (
+    "Место проведения:\n"
+    "Бобруйск, Городок. Подробности позже"
+)
+CONTACTS_MSG = f"Свяжитесь с организатором:\nПерейти в чат с {ORGANIZER_CONTACT}"
+
+_STATIC_REPLIES = {
+    "Расписание": SCHEDULE_MSG,
+    "Спикеры": SPEAKERS_MSG,
+    "Место проведения": LOCATION_MSG,
+    "Контакты": CONTACTS_MSG
+}
+
+# Кэш успешной проверки прав: статус бота в канале меняется редко,
+# поэтому положительный результат переиспользуется в течение TTL
+_perm_cache = {'expires': 0.0, 'value': False}
+_PERM_CACHE_TTL = 60.0
+
 # Функция для проверки прав бота в канале
 async def check_channel_permissions(context: ContextTypes.DEFAULT_TYPE):
+    now = time.monotonic()
+    if now < _perm_cache['expires']:
+        return _perm_cache['value']
     try:
         bot = context.bot
         chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=bot.id)
         if chat_member.status not in ['administrator', 'creator']:
             logger.error(f"Бот не является администратором канала {CHANNEL_ID}")
+            _perm_cache.update(expires=0.0, value=False)
             return False
         if not chat_member.can_post_messages:
             logger.error(f"Бот не имеет прав на отправку сообщений в канал {CHANNEL_ID}")
+            _perm_cache.update(expires=0.0, value=False)
             return False
         logger.info(f"Бот имеет необходимые права в канале {CHANNEL_ID}")
+        _perm_cache.update(expires=now + _PERM_CACHE_TTL, value=True)
         return True
     except Exception as e:
         logger.error(f"Ошибка проверки прав бота в канале {CHANNEL_ID}: {e}")
+        _perm_cache.update(expires=0.0, value=False)
         return False
 
+@retry_with_backoff()
+async def _send_channel_message(context, text, parse_mode=None):
+    await context.bot.send_message(chat_id=CHANNEL_ID, text=text, parse_mode=parse_mode)
+
+@retry_with_backoff()
+async def _reply_photo_with_retry(message, **kwargs):
+    return await message.reply_photo(**kwargs)
+
+@retry_with_backoff()
+async def _send_user_message(bot, chat_id, text, reply_markup=None):
+    await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+
 # Функция для отправки уведомлений админу с повторными попытками
-async def notify_admin(context, message, retries=3, backoff=2):
-    escaped_message = escape_markdown(message)
-    for attempt in range(retries):
-        try:
-            can_send = await check_channel_permissions(context)
-            if not can_send:
-                logger.error(f"Бот не может отправить уведомление админу: отсутствуют права в канале {CHANNEL_ID}")
-                return False
-            await context.bot.send_message(chat_id=CHANNEL_ID, text=f"Ошибка бота: {escaped_message}")
-            logger.info(f"Уведомление успешно отправлено в канал: {message}")
-            return True
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление админу (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(backoff * (2 ** attempt))
-            else:
-                logger.error(f"Не удалось отправить уведомление после {retries} попыток: {e}")
-                return False
+async def notify_admin(context, message):
+    can_send = await check_channel_permissions(context)
+    if not can_send:
+        logger.error(f"Бот не может отправить уведомление админу: отсутствуют права в канале {CHANNEL_ID}")
+        return False
+    try:
+        await _send_channel_message(context, f"Ошибка бота: {message}")
+        logger.info(f"Уведомление успешно отправлено в канал: {message}")
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось отправить уведомление после всех попыток: {e}")
+        return False
 
-# Функция для создания динамической клавиатуры
-def get_persistent_keyboard(user_id):
+# Клавиатура зависит только от трёх булевых признаков пользователя,
+# поэтому мемоизируем готовые ReplyKeyboardMarkup по кортежу состояния
+@functools.lru_cache(maxsize=8)
+def _keyboard_for_state(registered, in_room, initiated):
     keyboard = []
     first_row = []
-    if user_id not in registered_users:
+    if not registered:
         first_row.append("Регистрация")
     else:
-        if user_id in user_room:
+        if in_room:
             first_row.append("Отменить расселение")
-        elif user_id in accommodation_initiated and user_id not in user_room:
+        elif initiated:
             first_row.append("Расселить")
     if first_row:
         keyboard.append(first_row)
@@ -213,205 +466,416 @@ def get_persistent_keyboard(user_id):
         ["Место проведения", "Контакты"],
         ["QR Code"]
     ])
-    logger.info(f"Generated keyboard for user_id={user_id}, user_room={user_id in user_room}, registered={user_id in registered_users}, accommodation_initiated={user_id in accommodation_initiated}")
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
-# Функции загрузки и сохранения данных
-def load_registrations():
-    global registrations, user_registration_ids, registered_users
-    if worksheet is None:
-        logger.error("Google Sheets не инициализирован, загрузка регистраций невозможна")
+# Функция для создания динамической клавиатуры
+def get_persistent_keyboard(user_id):
+    return _keyboard_for_state(
+        user_id in registered_users,
+        user_id in user_room,
+        user_id in accommodation_initiated
+    )
+
+# Связывание user_id и registration_id с поддержкой обратного индекса
+def _link_user_registration(user_id, registration_id):
+    user_registration_ids[user_id] = registration_id
+    registration_user_ids[registration_id] = user_id
+
+# Функции загрузки и сохранения данных.
+# Блокирующие вызовы gspread выполняются в _sync_* вариантах через
+# asyncio.to_thread, чтобы не останавливать event loop на время HTTP-запросов.
+def _parse_registration_rows(values):
+    # values — сырые строки листа 'Лист1', первая строка — заголовки
+    logger.info(f"Получено {max(len(values) - 1, 0)} записей из Google Sheets")
+    registrations.clear()
+    user_registration_ids.clear()
+    registration_user_ids.clear()
+    rid_to_row.clear()
+    registered_users.clear()
+    if not values:
         return
-    retries = 3
-    for attempt in range(retries):
-        try:
-            records = worksheet.get_all_records()
-            logger.info(f"Получено {len(records)} записей из Google Sheets")
-            registrations.clear()
-            user_registration_ids.clear()
-            registered_users.clear()
-            for record in records:
-                registration_id = record['registration_id']
-                user_id = int(record['user_id'])
-                registrations[registration_id] = {
-                    'name': record['name'],
-                    'days': record['days'],
-                    'arrival_date': record['arrival_date'],
-                    'city': record['city'],
-                    'nick': record['nick'],
-                    'phone': record['phone'],
-                    'birth_date': record['birth_date'],
-                    'gender': record.get('gender', 'Не указан'),
-                    'accommodation': record.get('accommodation', 'Нет')
-                }
-                user_registration_ids[user_id] = registration_id
-                registered_users.add(user_id)
-            logger.info(f"Registrations loaded: {len(registrations)} записей, registered_users={registered_users}")
-            return
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке регистраций из Google Sheets (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 * (2 ** attempt))
-            else:
-                logger.error("Не удалось загрузить регистрации после всех попыток")
+    headers = values[0]
+    for offset, row in enumerate(values[1:]):
+        record = dict(zip(headers, row + [''] * (len(headers) - len(row))))
+        if not record.get('registration_id'):
+            continue
+        # Миграция старых id вида str(uuid4()): дефисы убираются, новые id
+        # выпускаются сразу в hex-форме (32 символа)
+        registration_id = record['registration_id'].replace('-', '')
+        user_id = int(record['user_id'])
+        registrations[registration_id] = {
+            'name': record['name'],
+            'days': record['days'],
+            'arrival_date': record['arrival_date'],
+            'city': record['city'],
+            'nick': record['nick'],
+            'phone': record['phone'],
+            'birth_date': record['birth_date'],
+            'gender': record.get('gender') or 'Не указан',
+            'accommodation': record.get('accommodation') or 'Нет'
+        }
+        _link_user_registration(user_id, registration_id)
+        rid_to_row[registration_id] = offset + 2
+        registered_users.add(user_id)
+    logger.info(f"Registrations loaded: {len(registrations)} записей, registered_users={registered_users}")
+
+@retry_with_backoff()
+def _sync_save_registrations():
+    worksheet.clear()
+    headers = ['registration_id', 'user_id', 'name', 'days', 'arrival_date', 'city', 'nick', 'phone', 'birth_date', 'gender', 'accommodation']
+    rows = [headers]
+    for registration_id, data in registrations.items():
+        user_id = registration_user_ids.get(registration_id)
+        if user_id is not None:
+            accommodation_status = "Да" if user_id in user_room else "Нет"
+            rows.append([
+                registration_id,
+                user_id,
+                data['name'],
+                data['days'],
+                data['arrival_date'],
+                data['city'],
+                data['nick'],
+                data['phone'],
+                data['birth_date'],
+                data['gender'],
+                accommodation_status
+            ])
+    # Одна пакетная запись вместо append_row на каждую строку (лимит квоты на запись)
+    worksheet.update(range_name=f'A1:K{len(rows)}', values=rows, value_input_option='RAW')
+    rid_to_row.clear()
+    rid_to_row.update({row[0]: i + 2 for i, row in enumerate(rows[1:])})
+    logger.info(f"Registrations saved: {len(registrations)} строк")
+
+_regs_dirty = asyncio.Event()
 
-def save_registrations(context=None):
+async def save_registrations(context=None):
     if worksheet is None:
         logger.error("Google Sheets не инициализирован, сохранение регистраций невозможно")
         if context:
-            asyncio.create_task(notify_admin(context, "Google Sheets не инициализирован"))
+            await notify_admin(context, "Google Sheets не инициализирован")
         return
-    retries = 3
-    for attempt in range(retries):
+    # Лист переписывается целиком, поэтому пишем отложенно: каскад событий
+    # за окно сброса превращается в одну перезапись
+    _regs_dirty.set()
+
+# Очередь отложенных операций с листом регистраций: точечные записи
+# значений и форматирование накапливаются и уходят одним batch-запросом,
+# чтобы каждое сканирование QR не делало отдельный HTTPS-запрос к Sheets
+_sheet_value_ops = []
+_sheet_format_ops = []
+_sheet_dirty = asyncio.Event()
+
+def _queue_row_green(row_idx):
+    _sheet_format_ops.append({
+        'range': f"A{row_idx}:K{row_idx}",
+        'format': {
+            "backgroundColor": {
+                "red": 0.678,
+                "green": 1.0,
+                "blue": 0.678
+            }
+        }
+    })
+    _sheet_dirty.set()
+
+def _queue_cell_update(range_name, value):
+    _sheet_value_ops.append({'range': range_name, 'values': [[value]]})
+    _sheet_dirty.set()
+
+@retry_with_backoff()
+def _sync_flush_sheet_ops(value_ops, format_ops):
+    if value_ops:
+        worksheet.batch_update(value_ops, value_input_option='RAW')
+    if format_ops:
+        worksheet.batch_format(format_ops)
+
+async def _sheet_flush_loop(flush_interval=2.0):
+    while True:
+        await _sheet_dirty.wait()
+        _sheet_dirty.clear()
+        await asyncio.sleep(flush_interval)
+        if worksheet is None:
+            # Лист ещё не инициализирован: операции остаются в очереди,
+            # флаг взводится заново — вернёмся к ним следующим циклом
+            _sheet_dirty.set()
+            continue
+        value_ops, format_ops = _sheet_value_ops[:], _sheet_format_ops[:]
+        del _sheet_value_ops[:len(value_ops)]
+        del _sheet_format_ops[:len(format_ops)]
         try:
-            worksheet.clear()
-            headers = ['registration_id', 'user_id', 'name', 'days', 'arrival_date', 'city', 'nick', 'phone', 'birth_date', 'gender', 'accommodation']
-            worksheet.append_row(headers)
-            for registration_id, data in registrations.items():
-                user_id = next((uid for uid, rid in user_registration_ids.items() if rid == registration_id), None)
-                if user_id is not None:
-                    accommodation_status = "Да" if user_id in user_room else "Нет"
-                    row = [
-                        registration_id,
-                        user_id,
-                        data['name'],
-                        data['days'],
-                        data['arrival_date'],
-                        data['city'],
-                        data['nick'],
-                        data['phone'],
-                        data['birth_date'],
-                        data['gender'],
-                        accommodation_status
-                    ]
-                    worksheet.append_row(row)
-            logger.info(f"Registrations saved: {len(registrations)} строк")
-            return
+            await asyncio.to_thread(_sync_flush_sheet_ops, value_ops, format_ops)
         except Exception as e:
-            logger.error(f"Ошибка при сохранении регистраций в Google Sheets (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 * (2 ** attempt))
-            else:
-                logger.error("Не удалось сохранить регистрации после всех попыток")
-                if context:
-                    asyncio.create_task(notify_admin(context, f"Ошибка сохранения регистраций после {retries} попыток: {e}"))
+            logger.error(f"Не удалось записать батч в Google Sheets после всех попыток: {e}")
 
-def load_accommodations():
+def _parse_accommodation_rows(records):
+    # records — сырые строки листа 'Расселение', первая строка — заголовки
     global room_assignments, user_room
-    if accommodation_worksheet is None:
-        logger.error("Google Sheets (Расселение) не инициализирован, загрузка данных невозможна")
+    if len(records) < 1:
+        logger.info("Лист 'Расселение' пуст, инициализация пустых домов")
         return
-    retries = 3
-    for attempt in range(retries):
-        try:
-            records = accommodation_worksheet.get_all_values()
-            if len(records) < 1:
-                logger.info("Лист 'Расселение' пуст, инициализация пустых домов")
-                return
-            headers = records[0]
-            room_assignments = {i+1: [] for i in range(10)}
-            user_room = {}
-            for row in records[1:]:
-                for i, cell in enumerate(row):
-                    if cell:
-                        room_number = i + 1
-                        if room_number <= 10:
-                            if len(room_assignments.get(room_number, [])) < 15:
-                                room_assignments[room_number].append(cell)
-                                for user_id, reg_id in user_registration_ids.items():
-                                    if registrations[reg_id]['name'] == cell:
-                                        user_room[user_id] = room_number
-                                        break
-                            else:
-                                logger.warning(f"Дом {room_number} превысил лимит в 15 мест при загрузке, запись {cell} пропущена")
-            logger.info(f"Accommodations loaded: {room_assignments}")
-            return
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке расселения из Google Sheets (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 * (2 ** attempt))
-            else:
-                logger.error("Не удалось загрузить расселение после всех попыток")
+    headers = records[0]
+    room_assignments = {i+1: set() for i in range(10)}
+    user_room = {}
+    # Индекс имя -> user_id строится один раз; при дубликатах имён берётся
+    # первый найденный, как и раньше при линейном поиске
+    name_to_uid = {}
+    name_counts = Counter(
+        registrations[reg_id]['name']
+        for reg_id in user_registration_ids.values()
+        if reg_id in registrations
+    )
+    for name, count in name_counts.items():
+        if count > 1:
+            logger.warning(f"Имя '{name}' встречается в {count} регистрациях: расселение будет сопоставлено первому user_id")
+    for user_id, reg_id in user_registration_ids.items():
+        if reg_id in registrations:
+            name_to_uid.setdefault(registrations[reg_id]['name'], user_id)
+    for row in records[1:]:
+        for i, cell in enumerate(row):
+            if cell:
+                room_number = i + 1
+                if room_number <= 10:
+                    if len(room_assignments.get(room_number, set())) < 15:
+                        room_assignments[room_number].add(cell)
+                        uid = name_to_uid.get(cell)
+                        if uid is not None:
+                            user_room[uid] = room_number
+                    else:
+                        logger.warning(f"Дом {room_number} превысил лимит в 15 мест при загрузке, запись {cell} пропущена")
+    logger.info(f"Accommodations loaded: {room_assignments}")
+
+@retry_with_backoff()
+def _sync_load_sheet_data():
+    # Один batchGet на оба листа вместо двух последовательных запросов
+    data = worksheet.spreadsheet.values_batch_get(["'Лист1'!A1:K", "'Расселение'!A1:J"])
+    value_ranges = data.get('valueRanges', [])
+    reg_values = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+    acc_values = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+    _parse_registration_rows(reg_values)
+    _parse_accommodation_rows(acc_values)
+
+async def load_sheet_data():
+    if worksheet is None or accommodation_worksheet is None:
+        logger.error("Google Sheets не инициализирован, загрузка данных невозможна")
+        return
+    try:
+        await asyncio.to_thread(_sync_load_sheet_data)
+    except Exception:
+        logger.error("Не удалось загрузить данные из Google Sheets после всех попыток")
+
+# Последняя записанная в лист матрица расселения: следующее сохранение
+# отправляет только изменившиеся ячейки вместо clear() + полной перезаписи
+_last_accom_matrix = None
 
-def save_accommodations(context=None):
+@retry_with_backoff()
+def _sync_save_accommodations():
+    global _last_accom_matrix
+    headers = [f'Дом {i+1}' for i in range(10)]
+    # Множества фиксируются в отсортированные колонки для стабильного вида листа
+    columns = [sorted(room_assignments.get(i+1, ())) for i in range(10)]
+    max_rows = max(len(col) for col in columns)
+    padded_grid = [headers] + [
+        [
+            columns[col_idx][row_idx] if row_idx < len(columns[col_idx]) else ''
+            for col_idx in range(10)
+        ]
+        for row_idx in range(max_rows)
+    ]
+    if _last_accom_matrix is None:
+        # Первое сохранение после запуска: полный снимок одной пакетной записью
+        accommodation_worksheet.clear()
+        accommodation_worksheet.update(range_name=f'A1:J{len(padded_grid)}', values=padded_grid, value_input_option='RAW')
+    else:
+        # Обычный случай ("разложить" двигает одного человека): diff в одну-две
+        # ячейки вместо перезаписи всей матрицы; пустая строка очищает ячейку
+        diffs = []
+        for row_idx in range(max(len(padded_grid), len(_last_accom_matrix))):
+            for col_idx in range(10):
+                new_value = padded_grid[row_idx][col_idx] if row_idx < len(padded_grid) else ''
+                old_value = _last_accom_matrix[row_idx][col_idx] if row_idx < len(_last_accom_matrix) else ''
+                if new_value != old_value:
+                    diffs.append({
+                        'range': gspread.utils.rowcol_to_a1(row_idx + 1, col_idx + 1),
+                        'values': [[new_value]],
+                    })
+        if diffs:
+            accommodation_worksheet.batch_update(diffs, value_input_option='RAW')
+    _last_accom_matrix = padded_grid
+    logger.info("Accommodations saved to Google Sheets")
+
+_accom_dirty = asyncio.Event()
+
+async def save_accommodations(context=None):
     if accommodation_worksheet is None:
         logger.error("Google Sheets (Расселение) не инициализирован, сохранение данных невозможно")
         if context:
-            asyncio.create_task(notify_admin(context, "Google Sheets (Расселение) не инициализирован"))
+            await notify_admin(context, "Google Sheets (Расселение) не инициализирован")
         return
-    retries = 3
-    for attempt in range(retries):
-        try:
-            accommodation_worksheet.clear()
-            headers = [f'Дом {i+1}' for i in range(10)]
-            accommodation_worksheet.append_row(headers)
-            max_rows = max(len(room_assignments.get(i+1, [])) for i in range(10)) + 1
-            for row_idx in range(1, max_rows):
-                row = []
-                for col_idx in range(10):
-                    if row_idx - 1 < len(room_assignments.get(col_idx + 1, [])):
-                        row.append(room_assignments[col_idx + 1][row_idx - 1])
-                    else:
-                        row.append('')
-                accommodation_worksheet.append_row(row)
-            logger.info("Accommodations saved to Google Sheets")
-            return
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении расселения в Google Sheets (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 * (2 ** attempt))
+    _accom_dirty.set()
+
+# Представление всех персистентных множеств статистики; checked_in хранит
+# registration_id (строки), остальные — user_id (int)
+def _current_stat_sets():
+    return {
+        'bot_opened': stats['bot_opened'],
+        'registered': stats['registered'],
+        'checked_in': stats['checked_in'],
+        'admin_users': admin_users,
+        'accommodation_initiated': accommodation_initiated
+    }
+
+# Состояние множеств на момент последней записи на диск и число строк журнала
+_stats_snapshot = {}
+_stats_log_lines = 0
+
+def _take_stats_snapshot():
+    global _stats_snapshot
+    _stats_snapshot = {k: set(v) for k, v in _current_stat_sets().items()}
+
+def _replay_stats_log():
+    global _stats_log_lines
+    if not os.path.exists(STATS_LOG_FILE):
+        return
+    count = 0
+    with open(STATS_LOG_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or '\t' not in line:
+                continue
+            op_key, value = line.split('\t', 1)
+            op, key = op_key[:1], op_key[1:]
+            target = _current_stat_sets().get(key)
+            if target is None or op not in ('+', '-'):
+                continue
+            if key != 'checked_in':
+                try:
+                    value = int(value)
+                except ValueError:
+                    continue
+            if op == '+':
+                target.add(value)
             else:
-                logger.error("Не удалось сохранить расселение после всех попыток")
-                if context:
-                    asyncio.create_task(notify_admin(context, f"Ошибка сохранения расселения после {retries} попыток: {e}"))
+                target.discard(value)
+            count += 1
+    _stats_log_lines = count
+    if count:
+        logger.info(f"Stats log: воспроизведено {count} строк журнала")
 
 def load_stats():
-    global stats, admin_users, accommodation_initiated
+    # Множества наполняются на месте, без перепривязки: на stats['registered']
+    # завязан алиас registered_users, а _current_stat_sets раздаёт ссылки
+    # на эти же объекты — новая привязка отцепила бы их от учёта
     try:
         if os.path.exists(STATS_FILE):
-            with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                stats = {k: set(v) for k, v in data.get('stats', {}).items()}
-                admin_users = set(data.get('admin_users', []))
-                accommodation_initiated = set(data.get('accommodation_initiated', []))
-                logger.info(f"Stats loaded: {stats}, Admins: {admin_users}, Accommodation Initiated: {accommodation_initiated}")
+            with open(STATS_FILE, 'rb') as f:
+                data = orjson.loads(f.read())
+            loaded_stats = data.get('stats', {})
+            for key, members in stats.items():
+                members.clear()
+                members.update(loaded_stats.get(key, []))
+            admin_users.clear()
+            admin_users.update(data.get('admin_users', []))
+            accommodation_initiated.clear()
+            accommodation_initiated.update(data.get('accommodation_initiated', []))
+            logger.info(f"Stats loaded: {stats}, Admins: {admin_users}, Accommodation Initiated: {accommodation_initiated}")
         else:
             logger.info("Stats file not found, starting fresh")
     except Exception as e:
         logger.error(f"Error loading stats: {e}")
-        stats = {'bot_opened': set(), 'registered': set(), 'checked_in': set()}
-        admin_users = set()
-        accommodation_initiated = set()
+        for members in stats.values():
+            members.clear()
+        admin_users.clear()
+        accommodation_initiated.clear()
+    _replay_stats_log()
+    _take_stats_snapshot()
+
+# Флаг "статистика изменилась"; запись коалесцируется фоновой задачей
+_stats_dirty = asyncio.Event()
+
+@retry_with_backoff()
+def _dump_stats_file():
+    tmp_path = STATS_FILE + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps({
+            'stats': {k: list(v) for k, v in stats.items()},
+            'admin_users': list(admin_users),
+            'accommodation_initiated': list(accommodation_initiated)
+        }))
+    os.replace(tmp_path, STATS_FILE)
+    logger.info(f"Stats saved: {stats}, Admins: {admin_users}, Accommodation Initiated: {accommodation_initiated}")
+
+@retry_with_backoff()
+def _append_stats_log():
+    # Дозаписываем только дельту с момента последней записи: O(изменений)
+    # вместо полной перезаписи JSON на каждое событие
+    global _stats_log_lines
+    lines = []
+    for key, members in _current_stat_sets().items():
+        prev = _stats_snapshot.get(key, set())
+        for m in members - prev:
+            lines.append(f"+{key}\t{m}\n")
+        for m in prev - members:
+            lines.append(f"-{key}\t{m}\n")
+    if not lines:
+        return
+    with open(STATS_LOG_FILE, 'a', encoding='utf-8') as f:
+        f.writelines(lines)
+    _take_stats_snapshot()
+    _stats_log_lines += len(lines)
+
+@retry_with_backoff()
+def _compact_stats_log():
+    global _stats_log_lines
+    _dump_stats_file()
+    open(STATS_LOG_FILE, 'w', encoding='utf-8').close()
+    _take_stats_snapshot()
+    _stats_log_lines = 0
+    logger.info("Stats log compacted")
+
+def _write_stats_file():
+    try:
+        if _stats_log_lines >= STATS_LOG_COMPACT_THRESHOLD:
+            _compact_stats_log()
+        else:
+            _append_stats_log()
+    except Exception:
+        logger.error("Не удалось сохранить статистику после всех попыток")
 
 def save_stats(context=None):
-    retries = 3
-    for attempt in range(retries):
+    # Не пишем файл сразу: помечаем статистику изменённой,
+    # фактическая запись выполняется в цикле отложенной записи
+    _stats_dirty.set()
+
+# Общий цикл отложенной записи: помеченный dirty-ресурс сбрасывается
+# одним вызовом после паузы, сколько бы событий ни пришло за окно
+async def _debounced_flush_loop(dirty_event, sync_write, name, flush_interval=2.0):
+    while True:
+        await dirty_event.wait()
+        dirty_event.clear()
+        await asyncio.sleep(flush_interval)
         try:
-            with open(STATS_FILE, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'stats': {k: list(v) for k, v in stats.items()},
-                    'admin_users': list(admin_users),
-                    'accommodation_initiated': list(accommodation_initiated)
-                }, f, ensure_ascii=False, indent=4)
-            logger.info(f"Stats saved: {stats}, Admins: {admin_users}, Accommodation Initiated: {accommodation_initiated}")
-            return
+            await asyncio.to_thread(sync_write)
         except Exception as e:
-            logger.error(f"Error saving stats (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 * (2 ** attempt))
-            else:
-                logger.error("Не удалось сохранить статистику после всех попыток")
-                if context:
-                    asyncio.create_task(notify_admin(context, f"Ошибка сохранения статистики после {retries} попыток: {e}"))
+            logger.error(f"Не удалось сохранить {name} после всех попыток: {e}")
 
 # Инициализация данных при запуске
 load_stats()
 
 # Асинхронная инициализация Google Sheets
 async def startup():
+    # Пул потоков для asyncio.to_thread: размер задаётся окружением,
+    # чтобы пиковые записи в Sheets не упирались в дефолтный лимит
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv('THREAD_POOL_SIZE', '16')))
+    )
+    _check_start_photo()
     await init_google_sheets()
-    load_registrations()
-    load_accommodations()
+    await load_sheet_data()
+    asyncio.create_task(_debounced_flush_loop(_stats_dirty, _write_stats_file, 'статистику'))
+    asyncio.create_task(_debounced_flush_loop(_regs_dirty, _sync_save_registrations, 'регистрации'))
+    asyncio.create_task(_debounced_flush_loop(_accom_dirty, _sync_save_accommodations, 'расселение'))
+    asyncio.create_task(_sheet_flush_loop())
 
 admin_keyboard = ReplyKeyboardMarkup([
     ["Статистика", "Очистить регистрации"],
@@ -438,10 +902,54 @@ async def admin_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Wrong admin password or unauthorized user_id={user_id}")
         await update.message.reply_text("Неверный пароль или доступ запрещен.", reply_markup=get_persistent_keyboard(user_id))
 
+async def _admin_stats(update, context, user_id):
+    logger.debug("Showing stats for user_id=%s", user_id)
+    stats_message = (
+        f"<b>Статистика:</b>\n"
+        f"Всего открыли бота: {len(stats['bot_opened'])}\n"
+        f"Всего прошло регистрацию: {len(stats['registered'])}\n"
+        f"Пришло: {len(stats['checked_in'])}\n"
+        f"Расселение: {len(user_room)}"
+    )
+    await update.message.reply_text(stats_message, parse_mode='HTML', reply_markup=admin_keyboard)
+
+async def _admin_clear(update, context, user_id):
+    logger.info(f"Clear registrations initiated by user_id={user_id}")
+    await update.message.reply_text(
+        "Вы уверены, что хотите очистить все регистрации?",
+        reply_markup=CONFIRM_CLEAR_KB
+    )
+
+async def _admin_sleep(update, context, user_id):
+    logger.info(f"Sleep process initiated by user_id={user_id}")
+    await update.message.reply_text(
+        "Начать процесс разложения спать для всех пользователей?",
+        reply_markup=CONFIRM_SLEEP_KB
+    )
+
+async def _admin_logout(update, context, user_id):
+    logger.info(f"Admin logout: user_id={user_id}")
+    admin_users.remove(user_id)
+    save_stats(context)
+    await update.message.reply_text(
+        "Вы вышли из режима администратора.",
+        reply_markup=get_persistent_keyboard(user_id)
+    )
+
+# Единая таблица "подпись кнопки -> обработчик": фильтр и роутер
+# используют один и тот же набор подписей
+ADMIN_ROUTES = {
+    "Статистика": _admin_stats,
+    "Очистить регистрации": _admin_clear,
+    "Разложить спать": _admin_sleep,
+    "Выйти из админки": _admin_logout,
+}
+ADMIN_BUTTONS = frozenset(ADMIN_ROUTES)
+
 async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     text = update.message.text.strip()
-    logger.info(f"Admin button pressed: user_id={user_id}, text={text}")
+    logger.debug("Admin button pressed: user_id=%s, text=%s", user_id, text)
     if user_id not in admin_users:
         logger.info(f"Unauthorized access attempt: user_id={user_id}")
         await update.message.reply_text(
@@ -449,93 +957,94 @@ async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=get_persistent_keyboard(user_id)
         )
         return ConversationHandler.END
-    if text == "Статистика":
-        logger.info(f"Showing stats for user_id={user_id}")
-        stats_message = (
-            f"*Статистика:*\n"
-            f"Всего открыли бота: {len(stats['bot_opened'])}\n"
-            f"Всего прошло регистрацию: {len(stats['registered'])}\n"
-            f"Пришло: {len(stats['checked_in'])}\n"
-            f"Расселение: {len(user_room)}"
-        )
-        await update.message.reply_text(stats_message, parse_mode='Markdown', reply_markup=admin_keyboard)
-    elif text == "Очистить регистрации":
-        logger.info(f"Clear registrations initiated by user_id={user_id}")
-        keyboard = [
-            [InlineKeyboardButton("Подтвердить", callback_data='confirm_clear')],
-            [InlineKeyboardButton("Отмена", callback_data='cancel_clear')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "Вы уверены, что хотите очистить все регистрации?",
-            reply_markup=reply_markup
-        )
-    elif text == "Разложить спать":
-        logger.info(f"Sleep process initiated by user_id={user_id}")
-        keyboard = [
-            [InlineKeyboardButton("Подтвердить", callback_data='confirm_sleep')],
-            [InlineKeyboardButton("Отмена", callback_data='cancel_sleep')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "Начать процесс разложения спать для всех пользователей?",
-            reply_markup=reply_markup
-        )
-    elif text == "Выйти из админки":
-        logger.info(f"Admin logout: user_id={user_id}")
-        admin_users.remove(user_id)
-        save_stats(context)
-        await update.message.reply_text(
-            "Вы вышли из режима администратора.",
-            reply_markup=get_persistent_keyboard(user_id)
-        )
+    handler = ADMIN_ROUTES.get(text)
+    if handler is not None:
+        await handler(update, context, user_id)
     return ConversationHandler.END
 
+# file_id стартового фото после первой загрузки: повторные /start
+# отправляют строку вместо чтения и заливки файла целиком
+start_photo_file_id = None
+
+WELCOME_MESSAGE = (
+    "Молодежный заезд Восток 2025\n"
+    "📅 Дата: 25.06.2025 - 01.07.2025\n"
+    "🎯 Тема: Христос - мой краеугольный камень\n"
+    "Место проведения - Бобруйск, Городок\n"
+    "<i>❕Регистрация с 1 апреля по 1 июня❕</i>"
+)
+
+RULES_MESSAGE = (
+    "<b>Правила посещения Молодежного заезда Восток 2025:</b>\n"
+    "1. Соблюдайте уважительное отношение ко всем участникам.\n"
+    "2. Запрещено употребление алкоголя, курение и наркотики.\n"
+    "3. Следуйте распорядку дня и указаниям организаторов.\n"
+    "4. Уважайте место проведения: не мусорите, соблюдайте чистоту.\n"
+    "5. Участие возможно только после регистрации и оплаты.\n"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global start_photo_file_id
     user_id = update.effective_user.id
     stats['bot_opened'].add(user_id)
     save_stats(context)
-    logger.info(f"Start command by user_id={user_id}")
-    welcome_message = (
-        "Молодежный заезд Восток 2025\n"
-        "📅 Дата: 25.06.2025 - 01.07.2025\n"
-        "🎯 Тема: Христос - мой краеугольный камень\n"
-        "Место проведения - Бобруйск, Городок\n"
-        "_❕Регистрация с 1 апреля по 1 июня❕_"
-    )
+    logger.debug("Start command by user_id=%s", user_id)
     keyboard = admin_keyboard if user_id in admin_users else get_persistent_keyboard(user_id)
-    retries = 3
-    backoff = 2
     if START_PHOTO_PATH:
-        for attempt in range(retries):
-            try:
-                with open(START_PHOTO_PATH, 'rb') as photo:
-                    await update.message.reply_photo(
-                        photo=photo,
-                        caption=welcome_message,
+        try:
+            if start_photo_file_id:
+                try:
+                    await _reply_photo_with_retry(
+                        update.message,
+                        photo=start_photo_file_id,
+                        caption=WELCOME_MESSAGE,
                         reply_markup=keyboard,
-                        parse_mode='Markdown'
+                        parse_mode='HTML'
                     )
-                logger.info(f"Photo sent successfully for user_id={user_id}")
-                return ConversationHandler.END
-            except Exception as e:
-                logger.error(f"Error sending photo (attempt {attempt+1}/{retries}): {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(backoff * (2 ** attempt))
-                else:
-                    logger.error("Не удалось отправить фото после всех попыток")
-                    await notify_admin(context, f"Ошибка отправки фото после {retries} попыток: {e}")
+                    return ConversationHandler.END
+                except BadRequest:
+                    logger.warning("file_id стартового фото недействителен, загружаем файл заново")
+                    start_photo_file_id = None
+            photo_bytes = await asyncio.to_thread(lambda: open(START_PHOTO_PATH, 'rb').read())
+            msg = await _reply_photo_with_retry(
+                update.message,
+                photo=InputFile(photo_bytes, filename=os.path.basename(START_PHOTO_PATH)),
+                caption=WELCOME_MESSAGE,
+                reply_markup=keyboard,
+                parse_mode='HTML'
+            )
+            if msg is not None and msg.photo:
+                start_photo_file_id = msg.photo[-1].file_id
+            logger.info(f"Photo sent successfully for user_id={user_id}")
+            return ConversationHandler.END
+        except Exception as e:
+            logger.error("Не удалось отправить фото после всех попыток")
+            await notify_admin(context, f"Ошибка отправки фото после всех попыток: {e}")
     await update.message.reply_text(
-        welcome_message,
+        WELCOME_MESSAGE,
         reply_markup=keyboard,
-        parse_mode='Markdown'
+        parse_mode='HTML'
     )
     return ConversationHandler.END
 
+# Общий вопрос о ночлеге: кнопка "Расселить" и callback
+# request_accommodation ведут в одну и ту же развилку
+async def _prompt_accommodation(message, user_id, source):
+    logger.info(f"User requested accommodation again: user_id={user_id}")
+    if user_id not in registered_users:
+        await message.reply_text("Зарегистрируйтесь сначала.", reply_markup=get_persistent_keyboard(user_id))
+        return ConversationHandler.END
+    await message.reply_text(
+        "Нужно ли вам место для ночлега?",
+        reply_markup=ACCOMMODATION_KB
+    )
+    logger.info(f"Sent accommodation query to user_id={user_id} after '{source}'")
+    return ConversationHandler.END
+
 async def handle_persistent_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
-    logger.info(f"Persistent button pressed: user_id={user_id}, text={text}")
+    logger.debug("Persistent button pressed: user_id=%s, text=%s", user_id, text)
     if user_id in admin_users:
         await update.message.reply_text("Вы в режиме администратора.", reply_markup=admin_keyboard)
         return ConversationHandler.END
@@ -550,80 +1059,31 @@ async def handle_persistent_buttons(update: Update, context: ContextTypes.DEFAUL
             reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text("Вы уже зарегистрированы!", reply_markup=reply_markup)
             return ConversationHandler.END
-        rules_message = (
-            "*Правила посещения Молодежного заезда Восток 2025:*\n"
-            "1. Соблюдайте уважительное отношение ко всем участникам.\n"
-            "2. Запрещено употребление алкоголя, курение и наркотики.\n"
-            "3. Следуйте распорядку дня и указаниям организаторов.\n"
-            "4. Уважайте место проведения: не мусорите, соблюдайте чистоту.\n"
-            "5. Участие возможно только после регистрации и оплаты.\n"
-        )
-        keyboard = [[InlineKeyboardButton("Согласен с правилами", callback_data='agree')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            rules_message,
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
+            RULES_MESSAGE,
+            reply_markup=AGREE_KB,
+            parse_mode='HTML'
         )
         return ConversationHandler.END
-    elif text == "Расписание":
-        schedule_message = (
-            "Распорядок дня:\n"
-            "- 08:00 - Завтрак\n"
-            "- 09:00 - Утреннее богослужение\n"
-            "- 11:00 - Семинары и мастер-классы\n"
-            "- 13:00 - Обед\n"
-            "- 14:00 - Свободное время/спорт\n"
-            "- 17:00 - Вечернее богослужение\n"
-            "- 19:00 - Ужин\n"
-            "- 20:00 - Вечерняя программа (концерты, общение)"
-        )
-        await update.message.reply_text(schedule_message, reply_markup=get_persistent_keyboard(user_id))
-    elif text == "Спикеры":
-        speakers_message = (
-            "Спикеры:\n"
-            "- Иван Петров - пастор, автор книги 'Живи с верой'\n"
-            "- Анна Смирнова - молодежный лидер, спикер TEDx\n"
-            "- Сергей Ковалев - евангелист, миссионер"
-        )
-        await update.message.reply_text(speakers_message, reply_markup=get_persistent_keyboard(user_id))
-    elif text == "Место проведения":
-        location_message = (
-            "Место проведения:\n"
-            "Бобруйск, Городок. Подробности позже"
-        )
-        await update.message.reply_text(location_message, reply_markup=get_persistent_keyboard(user_id))
-    elif text == "Контакты":
-        await update.message.reply_text(
-            f"Свяжитесь с организатором:\nПерейти в чат с {ORGANIZER_CONTACT}",
-            reply_markup=get_persistent_keyboard(user_id)
-        )
+    elif text in _STATIC_REPLIES:
+        await update.message.reply_text(_STATIC_REPLIES[text], reply_markup=get_persistent_keyboard(user_id))
     elif text == "QR Code":
         registration_id = user_registration_ids.get(user_id)
         if registration_id:
-            qr = qrcode.make(registration_id)
-            img_byte_arr = io.BytesIO()
-            qr.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            retries = 3
-            for attempt in range(retries):
-                try:
-                    await update.message.reply_photo(
-                        photo=img_byte_arr,
-                        caption="Ваш QR-код для регистрации\nАдмин подтвердит вашу регистрацию после сканирования.",
-                        reply_markup=get_persistent_keyboard(user_id)
-                    )
-                    return ConversationHandler.END
-                except Exception as e:
-                    logger.error(f"Error sending QR code (attempt {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        await notify_admin(context, f"Ошибка отправки QR-кода после {retries} попыток: {e}")
-                        await update.message.reply_text(
-                            "Не удалось отправить QR-код. Пожалуйста, попробуйте снова.",
-                            reply_markup=get_persistent_keyboard(user_id)
-                        )
+            try:
+                await send_qr_photo(
+                    update.message,
+                    registration_id,
+                    caption="Ваш QR-код для регистрации\nАдмин подтвердит вашу регистрацию после сканирования.",
+                    reply_markup=get_persistent_keyboard(user_id)
+                )
+                return ConversationHandler.END
+            except Exception as e:
+                await notify_admin(context, f"Ошибка отправки QR-кода после всех попыток: {e}")
+                await update.message.reply_text(
+                    "Не удалось отправить QR-код. Пожалуйста, попробуйте снова.",
+                    reply_markup=get_persistent_keyboard(user_id)
+                )
         else:
             await update.message.reply_text(
                 "QR-код недоступен. Пожалуйста, завершите регистрацию.",
@@ -640,448 +1100,380 @@ async def handle_persistent_buttons(update: Update, context: ContextTypes.DEFAUL
             return ConversationHandler.END
         user_name = registrations[registration_id]['name']
         room_number = user_room[user_id]
-        if user_name in room_assignments.get(room_number, []):
-            room_assignments[room_number].remove(user_name)
+        room_assignments.get(room_number, set()).discard(user_name)
         del user_room[user_id]
-        save_accommodations(context)
+        await save_accommodations(context)
         save_stats(context)
         registrations[registration_id]['accommodation'] = 'Нет'
-        save_registrations(context)
+        await save_registrations(context)
         await update.message.reply_text(
             "Расселение отменено.",
             reply_markup=get_persistent_keyboard(user_id)
         )
         return ConversationHandler.END
     elif text == "Расселить":
-        logger.info(f"User requested accommodation again: user_id={user_id}")
-        if user_id not in registered_users:
-            await update.message.reply_text("Зарегистрируйтесь сначала.", reply_markup=get_persistent_keyboard(user_id))
-            return ConversationHandler.END
-        keyboard = [
-            [InlineKeyboardButton("Да", callback_data='need_accommodation')],
-            [InlineKeyboardButton("Нет", callback_data='no_accommodation')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "Нужно ли вам место для ночлега?",
-            reply_markup=reply_markup
-        )
-        logger.info(f"Sent accommodation query to user_id={user_id} after 'Расселить'")
-        return ConversationHandler.END
+        return await _prompt_accommodation(update.message, user_id, 'Расселить')
     return ConversationHandler.END
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    data = query.data
-    logger.info(f"Callback query: user_id={user_id}, data={data}")
+async def _cb_agree(user_id, query, context, payload):
+    logger.info(f"User agreed to rules: user_id={user_id}")
+    await query.message.reply_text("Напишите своё ФИО (например, Иванов Иван Иванович):")
+    return NAME
 
-    if data == 'agree':
-        logger.info(f"User agreed to rules: user_id={user_id}")
-        await query.message.reply_text("Напишите своё ФИО (например, Иванов Иван Иванович):")
-        return NAME
-    elif data.startswith('days_'):
-        days = int(data.split('_')[1])
-        user_data[user_id] = user_data.get(user_id, {})
-        user_data[user_id]['days'] = days
-        logger.info(f"User selected days: user_id={user_id}, days={days}")
-        keyboard = [[InlineKeyboardButton(date, callback_data=f'date_{date}')] for date in dates]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text("Выберите дату приезда:", reply_markup=reply_markup)
-        return ARRIVAL_DATE
-    elif data.startswith('date_'):
-        date = data.split('_')[1]
-        user_data[user_id]['arrival_date'] = date
-        logger.info(f"User selected arrival date: user_id={user_id}, date={date}")
-        await query.message.reply_text("Из какого города вы приедете?", reply_markup=ReplyKeyboardRemove())
-        return CITY
-    elif data.startswith('gender_'):
-        gender = data.split('_')[1]
-        logger.info(f"Processing gender selection: user_id={user_id}, gender={gender}")
-        user_data[user_id] = user_data.get(user_id, {})
-        user_data[user_id]['gender'] = gender
-        logger.info(f"User selected gender: user_id={user_id}, gender={gender}")
-        registration_id = str(uuid.uuid4())
-        data = user_data[user_id]
-        registrations[registration_id] = {
-            'name': data['name'],
-            'days': data['days'],
-            'arrival_date': data['arrival_date'],
-            'city': data['city'],
-            'nick': data['nick'],
-            'phone': data['phone'],
-            'birth_date': data['birth_date'],
-            'gender': data['gender'],
-            'accommodation': 'Нет'
-        }
-        stats['registered'].add(user_id)
-        registered_users.add(user_id)
-        user_registration_ids[user_id] = registration_id
-        save_stats(context)
-        save_registrations(context)
-        logger.info(f"Registration completed: user_id={user_id}, registration_id={registration_id}")
-        confirmation_message = (
-            "Регистрация успешна!\n"
-            f"ФИО: {escape_markdown(data['name'])}\n"
-            f"Кол-во дней: {data['days']}\n"
-            f"Дата приезда: {data['arrival_date']}\n"
-            f"Город: {escape_markdown(data['city'])}\n"
-            f"Ник: {escape_markdown(data['nick'])}\n"
-            f"Телефон: {escape_markdown(data['phone'])}\n"
-            f"Дата рождения: {data['birth_date']}\n"
-            f"Пол: {data['gender']}\n"
-            "Ждем вас на мероприятии!"
-        )
-        qr = qrcode.make(registration_id)
-        img_byte_arr = io.BytesIO()
-        qr.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        channel_message = (
-            "*Новая регистрация!*\n"
-            f"ФИО: {escape_markdown(data['name'])}\n"
-            f"Кол-во дней: {data['days']}\n"
-            f"Дата приезда: {data['arrival_date']}\n"
-            f"Город: {escape_markdown(data['city'])}\n"
-            f"Ник: {escape_markdown(data.get('nick', 'Не указан'))}\n"
-            f"Телефон: {escape_markdown(data.get('phone', 'Не указан'))}\n"
-            f"Дата рождения: {data.get('birth_date', 'Не указана')}\n"
-            f"Пол: {data.get('gender', 'Не указан')}\n"
-            "Ждем вас на мероприятии!"
-        )
-        retries = 3
-        backoff = 2
-        success = False
-        for attempt in range(retries):
+async def _cb_days(user_id, query, context, payload):
+    days = int(payload)
+    user_data[user_id] = user_data.get(user_id, {})
+    user_data[user_id]['days'] = days
+    logger.info(f"User selected days: user_id={user_id}, days={days}")
+    await query.message.reply_text("Выберите дату приезда:", reply_markup=DATES_KB)
+    return ARRIVAL_DATE
+
+async def _cb_date(user_id, query, context, payload):
+    user_data[user_id]['arrival_date'] = payload
+    logger.info(f"User selected arrival date: user_id={user_id}, date={payload}")
+    await query.message.reply_text("Из какого города вы приедете?", reply_markup=ReplyKeyboardRemove())
+    return CITY
+
+async def _cb_gender(user_id, query, context, payload):
+    gender = payload
+    logger.info(f"Processing gender selection: user_id={user_id}, gender={gender}")
+    user_data[user_id] = user_data.get(user_id, {})
+    user_data[user_id]['gender'] = gender
+    logger.info(f"User selected gender: user_id={user_id}, gender={gender}")
+    registration_id = uuid.uuid4().hex
+    data = user_data[user_id]
+    registrations[registration_id] = {
+        'name': data['name'],
+        'days': data['days'],
+        'arrival_date': data['arrival_date'],
+        'city': data['city'],
+        'nick': data['nick'],
+        'phone': data['phone'],
+        'birth_date': data['birth_date'],
+        'gender': data['gender'],
+        'accommodation': 'Нет'
+    }
+    registered_users.add(user_id)
+    _link_user_registration(user_id, registration_id)
+    save_stats(context)
+    await save_registrations(context)
+    logger.info(f"Registration completed: user_id={user_id}, registration_id={registration_id}")
+    # Тело карточки одно на оба сообщения — экранировка выполняется один раз
+    summary_body = _registration_body(data, days_label="Кол-во дней")
+    confirmation_message = f"Регистрация успешна!\n{summary_body}\nЖдем вас на мероприятии!"
+    channel_message = f"<b>Новая регистрация!</b>\n{summary_body}\nЖдем вас на мероприятии!"
+    # Анонс в канал не зависит от ответа пользователю: запускаем его
+    # фоновой задачей, чтобы ретраи канала не задерживали выдачу QR-кода
+    async def _announce_registration():
+        can_send = await check_channel_permissions(context)
+        if not can_send:
+            logger.error(f"Бот не может отправить сообщение в канал {CHANNEL_ID}: отсутствуют права")
+            await notify_admin(context, f"Бот не имеет прав для отправки сообщений в канал {CHANNEL_ID}. Пожалуйста, добавьте бота в канал и дайте права администратора.")
+        else:
             try:
-                can_send = await check_channel_permissions(context)
-                if not can_send:
-                    logger.error(f"Бот не может отправить сообщение в канал {CHANNEL_ID}: отсутствуют права")
-                    await notify_admin(context, f"Бот не имеет прав для отправки сообщений в канал {CHANNEL_ID}. Пожалуйста, добавьте бота в канал и дайте права администратора.")
-                    break
-                logger.info(f"Попытка отправки сообщения в канал {CHANNEL_ID} (попытка {attempt+1}/{retries}): {channel_message}")
-                await context.bot.send_message(chat_id=CHANNEL_ID, text=channel_message, parse_mode='Markdown')
+                await _send_channel_message(context, channel_message, parse_mode='HTML')
                 logger.info(f"Сообщение успешно отправлено в канал: user_id={user_id}, registration_id={registration_id}")
-                success = True
-                break
+                return
             except Exception as e:
-                logger.error(f"Ошибка отправки в канал (попытка {attempt+1}/{retries}): {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(backoff * (2 ** attempt))
-                else:
-                    logger.error(f"Не удалось отправить сообщение в канал после {retries} попыток: {e}")
-                    await notify_admin(context, f"Ошибка отправки сообщения в канал после {retries} попыток: {e}")
-        if not success:
-            logger.warning(f"Сообщение не отправлено в канал для user_id={user_id}, registration_id={registration_id}")
-        for attempt in range(retries):
+                logger.error(f"Не удалось отправить сообщение в канал после всех попыток: {e}")
+                await notify_admin(context, f"Ошибка отправки сообщения в канал после всех попыток: {e}")
+        logger.warning(f"Сообщение не отправлено в канал для user_id={user_id}, registration_id={registration_id}")
+    channel_task = asyncio.create_task(_announce_registration())
+    try:
+        await send_qr_photo(
+            query.message,
+            registration_id,
+            caption=confirmation_message,
+            reply_markup=get_persistent_keyboard(user_id),
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        await notify_admin(context, f"Ошибка отправки QR-кода регистрации после всех попыток: {e}")
+        await query.message.reply_text(
+            confirmation_message,
+            reply_markup=get_persistent_keyboard(user_id),
+            parse_mode='HTML'
+        )
+    await channel_task
+    user_data.pop(user_id, None)
+    return ConversationHandler.END
+
+async def _cb_confirm_clear(user_id, query, context, payload):
+    logger.info(f"Confirm clear registrations by user_id={user_id}")
+    if user_id not in admin_users:
+        await query.message.reply_text("Вы не администратор.")
+        return ConversationHandler.END
+    registered_users.clear()
+    stats['checked_in'].clear()
+    _greened_registrations.clear()
+    registrations.clear()
+    user_registration_ids.clear()
+    registration_user_ids.clear()
+    room_assignments.clear()
+    room_assignments.update({i+1: set() for i in range(10)})
+    user_room.clear()
+    accommodation_initiated.clear()
+    qr_cache.clear()
+    qr_file_id.clear()
+    save_stats(context)
+    await save_registrations(context)
+    await save_accommodations(context)
+    await query.message.edit_text("Данные очищены!", reply_markup=None)
+    await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    async def _send_keyboard_update(uid):
+        async with BROADCAST_SEM:
             try:
-                await query.message.reply_photo(
-                    photo=img_byte_arr,
-                    caption=confirmation_message,
-                    reply_markup=get_persistent_keyboard(user_id),
-                    parse_mode='Markdown'
+                await _send_user_message(
+                    context.bot, uid,
+                    "Данные регистрации очищены. Вы можете зарегистрироваться заново.",
+                    reply_markup=get_persistent_keyboard(uid)
                 )
-                break
+                logger.info(f"Sent keyboard update to user_id={uid}")
+                return True
             except Exception as e:
-                logger.error(f"Error sending registration QR code (attempt {attempt+1}/{retries}): {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(backoff * (2 ** attempt))
-                else:
-                    await notify_admin(context, f"Ошибка отправки QR-кода регистрации после {retries} попыток: {e}")
-                    await query.message.reply_text(
-                        confirmation_message,
-                        reply_markup=get_persistent_keyboard(user_id),
-                        parse_mode='Markdown'
-                    )
-        user_data.pop(user_id, None)
+                await notify_admin(context, f"Ошибка отправки обновления клавиатуры user_id={uid} после всех попыток: {e}")
+                return False
+
+    await asyncio.gather(*(_send_keyboard_update(uid) for uid in stats['bot_opened']), return_exceptions=True)
+    logger.info(f"Registrations cleared successfully by user_id={user_id}")
+    return ConversationHandler.END
+
+async def _cb_cancel_clear(user_id, query, context, payload):
+    logger.info(f"Cancel clear registrations by user_id={user_id}")
+    await query.message.edit_text("Очистка отменена.", reply_markup=None)
+    await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    return ConversationHandler.END
+
+async def _cb_confirm_sleep(user_id, query, context, payload):
+    logger.info(f"Confirm sleep by user_id={user_id}")
+    if user_id not in admin_users:
+        await query.message.reply_text("Вы не администратор.")
         return ConversationHandler.END
-    elif data == 'confirm_clear':
-        logger.info(f"Confirm clear registrations by user_id={user_id}")
-        if user_id not in admin_users:
-            await query.message.reply_text("Вы не администратор.")
-            return ConversationHandler.END
-        stats['registered'].clear()
-        stats['checked_in'].clear()
-        registered_users.clear()
-        registrations.clear()
-        user_registration_ids.clear()
-        room_assignments.clear()
-        room_assignments.update({i+1: [] for i in range(10)})
-        user_room.clear()
-        accommodation_initiated.clear()
-        save_stats(context)
-        save_registrations(context)
-        save_accommodations(context)
-        await query.message.edit_text("Данные очищены!", reply_markup=None)
-        await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
-        retries = 3
-        for uid in stats['bot_opened']:
-            for attempt in range(retries):
-                try:
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text="Данные регистрации очищены. Вы можете зарегистрироваться заново.",
-                        reply_markup=get_persistent_keyboard(uid)
-                    )
-                    await asyncio.sleep(0.1)
-                    logger.info(f"Sent keyboard update to user_id={uid}")
-                    break
-                except Exception as e:
-                    logger.error(f"Error sending keyboard update to user_id={uid} (attempt {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        await notify_admin(context, f"Ошибка отправки обновления клавиатуры user_id={uid} после {retries} попыток: {e}")
-        logger.info(f"Registrations cleared successfully by user_id={user_id}")
+    async def _send_accommodation_query(uid):
+        async with BROADCAST_SEM:
+            accommodation_initiated.add(uid)
+            try:
+                await _send_user_message(
+                    context.bot, uid,
+                    "Нужно ли вам место для ночлега?",
+                    reply_markup=ACCOMMODATION_KB
+                )
+                logger.info(f"Sent accommodation query to user_id={uid}")
+                return True
+            except Exception as e:
+                await notify_admin(context, f"Ошибка отправки запроса на расселение user_id={uid} после всех попыток: {e}")
+                return False
+
+    results = await asyncio.gather(*(_send_accommodation_query(uid) for uid in registered_users), return_exceptions=True)
+    sent_count = sum(1 for r in results if r is True)
+    save_stats(context)
+    await query.message.edit_text(f"Процесс разложения спать начат. Сообщение отправлено {sent_count} пользователям.", reply_markup=None)
+    await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    return ConversationHandler.END
+
+async def _cb_cancel_sleep(user_id, query, context, payload):
+    logger.info(f"Cancel sleep by user_id={user_id}")
+    await query.message.edit_text("Разложение спать отменено.", reply_markup=None)
+    await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    return ConversationHandler.END
+
+async def _cb_need_accommodation(user_id, query, context, payload):
+    logger.info(f"User needs accommodation: user_id={user_id}")
+    if user_id not in registered_users:
+        await query.message.reply_text("Зарегистрируйтесь сначала.", reply_markup=get_persistent_keyboard(user_id))
         return ConversationHandler.END
-    elif data == 'cancel_clear':
-        logger.info(f"Cancel clear registrations by user_id={user_id}")
-        await query.message.edit_text("Очистка отменена.", reply_markup=None)
-        await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    registration_id = user_registration_ids.get(user_id)
+    if not registration_id:
+        await query.message.reply_text("Ошибка: регистрация не найдена.", reply_markup=get_persistent_keyboard(user_id))
         return ConversationHandler.END
-    elif data == 'confirm_sleep':
-        logger.info(f"Confirm sleep by user_id={user_id}")
-        if user_id not in admin_users:
-            await query.message.reply_text("Вы не администратор.")
-            return ConversationHandler.END
-        sent_count = 0
-        keyboard = [
-            [InlineKeyboardButton("Да", callback_data='need_accommodation')],
-            [InlineKeyboardButton("Нет", callback_data='no_accommodation')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        retries = 3
-        for uid in registered_users:
-            for attempt in range(retries):
-                try:
-                    accommodation_initiated.add(uid)
-                    await context.bot.send_message(
-                        chat_id=uid,
-                        text="Нужно ли вам место для ночлега?",
-                        reply_markup=reply_markup
-                    )
-                    sent_count += 1
-                    await asyncio.sleep(0.1)
-                    logger.info(f"Sent accommodation query to user_id={uid}")
-                    break
-                except Exception as e:
-                    logger.error(f"Error sending to user_id={uid} (attempt {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        await notify_admin(context, f"Ошибка отправки запроса на расселение user_id={uid} после {retries} попыток: {e}")
-        save_stats(context)
-        await query.message.edit_text(f"Процесс разложения спать начат. Сообщение отправлено {sent_count} пользователям.", reply_markup=None)
-        await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    gender = registrations[registration_id]['gender']
+    logger.info(f"User gender: user_id={user_id}, gender={gender}")
+    keyboard = []
+    row = []
+    available_rooms = False
+    rooms_range = GENDER_ROOMS.get(gender)
+    if rooms_range is None:
+        await query.message.reply_text("Пол не указан. Обратитесь к администратору.", reply_markup=get_persistent_keyboard(user_id))
         return ConversationHandler.END
-    elif data == 'cancel_sleep':
-        logger.info(f"Cancel sleep by user_id={user_id}")
-        await query.message.edit_text("Разложение спать отменено.", reply_markup=None)
-        await query.message.reply_text("Выберите действие:", reply_markup=admin_keyboard)
+    for room in rooms_range:
+        if room not in room_assignments:
+            room_assignments[room] = set()
+        occupied = len(room_assignments[room])
+        logger.debug("House %s: occupied=%s", room, occupied)
+        if occupied < 15:
+            row.append(InlineKeyboardButton(f"{room} дом ({occupied}/15)", callback_data=f'room_{room}'))
+            available_rooms = True
+            if len(row) == 3:
+                keyboard.append(row)
+                row = []
+        else:
+            logger.info(f"House {room} is full: {occupied}/15")
+    if row:
+        keyboard.append(row)
+    if not available_rooms:
+        await query.message.reply_text("Все доступные дома заняты.", reply_markup=get_persistent_keyboard(user_id))
         return ConversationHandler.END
-    elif data == 'need_accommodation':
-        logger.info(f"User needs accommodation: user_id={user_id}")
-        if user_id not in registered_users:
-            await query.message.reply_text("Зарегистрируйтесь сначала.", reply_markup=get_persistent_keyboard(user_id))
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.message.edit_text("Выберите дом:", reply_markup=reply_markup)
+    logger.info(f"Sent house selection keyboard to user_id={user_id}, keyboard={keyboard}")
+    return ROOM
+
+async def _cb_no_accommodation(user_id, query, context, payload):
+    logger.info(f"User declined accommodation: user_id={user_id}")
+    await query.message.edit_text("Запаситесь спреями от комаров.", reply_markup=None)
+    await query.message.reply_text("Вы отказались от расселения.", reply_markup=get_persistent_keyboard(user_id))
+    return ConversationHandler.END
+
+async def _cb_request_accommodation(user_id, query, context, payload):
+    return await _prompt_accommodation(query.message, user_id, 'request_accommodation')
+
+async def _cb_room(user_id, query, context, payload):
+    logger.info(f"Attempting to process house selection: user_id={user_id}, room={payload}")
+    try:
+        room_number = int(payload)
+        logger.info(f"Extracted room_number: {room_number}")
+        if room_number not in range(1, 11):
+            await query.message.reply_text("Недопустимый номер дома.", reply_markup=get_persistent_keyboard(user_id))
             return ConversationHandler.END
         registration_id = user_registration_ids.get(user_id)
         if not registration_id:
             await query.message.reply_text("Ошибка: регистрация не найдена.", reply_markup=get_persistent_keyboard(user_id))
             return ConversationHandler.END
         gender = registrations[registration_id]['gender']
-        logger.info(f"User gender: user_id={user_id}, gender={gender}")
-        keyboard = []
-        row = []
-        available_rooms = False
-        if gender == "Мужской":
-            rooms_range = range(1, 6)
-        elif gender == "Женский":
-            rooms_range = range(6, 11)
-        else:
-            await query.message.reply_text("Пол не указан. Обратитесь к администратору.", reply_markup=get_persistent_keyboard(user_id))
-            return ConversationHandler.END
-        for room in rooms_range:
-            if room not in room_assignments:
-                room_assignments[room] = []
-            occupied = len(room_assignments[room])
-            logger.info(f"House {room}: occupied={occupied}")
-            if occupied < 15:
-                row.append(InlineKeyboardButton(f"{room} дом ({occupied}/15)", callback_data=f'room_{room}'))
-                available_rooms = True
-                if len(row) == 3:
-                    keyboard.append(row)
-                    row = []
-            else:
-                logger.info(f"House {room} is full: {occupied}/15")
-        if row:
-            keyboard.append(row)
-        if not available_rooms:
-            await query.message.reply_text("Все доступные дома заняты.", reply_markup=get_persistent_keyboard(user_id))
+        if room_number not in GENDER_ROOMS.get(gender, ()):
+            await query.message.reply_text("Этот дом недоступен для вашего пола.", reply_markup=get_persistent_keyboard(user_id))
             return ConversationHandler.END
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text("Выберите дом:", reply_markup=reply_markup)
-        logger.info(f"Sent house selection keyboard to user_id={user_id}, keyboard={keyboard}")
-        return ROOM
-    elif data == 'no_accommodation':
-        logger.info(f"User declined accommodation: user_id={user_id}")
-        await query.message.edit_text("Запаситесь спреями от комаров.", reply_markup=None)
-        await query.message.reply_text("Вы отказались от расселения.", reply_markup=get_persistent_keyboard(user_id))
-        return ConversationHandler.END
-    elif data == 'request_accommodation':
-        logger.info(f"User requested accommodation again: user_id={user_id}")
-        if user_id not in registered_users:
-            await query.message.reply_text("Зарегистрируйтесь сначала.", reply_markup=get_persistent_keyboard(user_id))
+        if room_number not in room_assignments:
+            room_assignments[room_number] = set()
+        occupied = len(room_assignments[room_number])
+        logger.info(f"House {room_number}: occupied={occupied}")
+        if occupied >= 15:
+            await query.message.reply_text("Этот дом занят. Выберите другой.", reply_markup=get_persistent_keyboard(user_id))
             return ConversationHandler.END
-        keyboard = [
-            [InlineKeyboardButton("Да", callback_data='need_accommodation')],
-            [InlineKeyboardButton("Нет", callback_data='no_accommodation')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text(
-            "Нужно ли вам место для ночлега?",
-            reply_markup=reply_markup
-        )
-        logger.info(f"Sent accommodation query to user_id={user_id} after 'request_accommodation'")
-        return ConversationHandler.END
-    elif data.startswith('room_'):
-        logger.info(f"Attempting to process house selection: user_id={user_id}, data={data}")
+        user_name = registrations[registration_id]['name']
+        prev_room = user_room.get(user_id)
+        if prev_room is not None and prev_room != room_number:
+            room_assignments.get(prev_room, set()).discard(user_name)
+            logger.info(f"Removed user_name={user_name} from house {prev_room}")
+        room_assignments[room_number].add(user_name)
+        user_room[user_id] = room_number
+        await save_accommodations(context)
+        data = registrations[registration_id]
+        data['accommodation'] = 'Да'
+        await save_registrations(context)
+        await query.message.edit_text(f"Вы забронировали в доме {room_number}.", parse_mode='HTML')
+        response = _registration_summary(
+            data, title="<b>Ваше место для ночлега:</b>",
+            footer=f"Ночлег в {room_number} доме.")
         try:
-            room_number = int(data.split('_')[1])
-            logger.info(f"Extracted room_number: {room_number}")
-            if room_number not in range(1, 11):
-                await query.message.reply_text("Недопустимый номер дома.", reply_markup=get_persistent_keyboard(user_id))
-                return ConversationHandler.END
-            registration_id = user_registration_ids.get(user_id)
-            if not registration_id:
-                await query.message.reply_text("Ошибка: регистрация не найдена.", reply_markup=get_persistent_keyboard(user_id))
-                return ConversationHandler.END
-            gender = registrations[registration_id]['gender']
-            if (gender == "Мужской" and room_number > 5) or (gender == "Женский" and room_number < 6):
-                await query.message.reply_text("Этот дом недоступен для вашего пола.", reply_markup=get_persistent_keyboard(user_id))
-                return ConversationHandler.END
-            if room_number not in room_assignments:
-                room_assignments[room_number] = []
-            occupied = len(room_assignments[room_number])
-            logger.info(f"House {room_number}: occupied={occupied}")
-            if occupied >= 15:
-                await query.message.reply_text("Этот дом занят. Выберите другой.", reply_markup=get_persistent_keyboard(user_id))
-                return ConversationHandler.END
-            user_name = registrations[registration_id]['name']
-            for r in range(1, 11):
-                if user_name in room_assignments.get(r, []):
-                    room_assignments[r].remove(user_name)
-                    logger.info(f"Removed user_name={user_name} from house {r}")
-            room_assignments[room_number].append(user_name)
-            user_room[user_id] = room_number
-            save_accommodations(context)
-            data = registrations[registration_id]
-            data['accommodation'] = 'Да'
-            save_registrations(context)
-            await query.message.edit_text(f"Вы забронировали в доме {room_number}.", parse_mode='Markdown')
-            response = (
-                "*Ваше место для ночлега:*\n"
-                f"ФИО: {escape_markdown(data['name'])}\n"
-                f"Количество дней: {data['days']}\n"
-                f"Дата приезда: {data['arrival_date']}\n"
-                f"Город: {escape_markdown(data['city'])}\n"
-                f"Ник: {escape_markdown(data.get('nick', 'Не указан'))}\n"
-                f"Телефон: {escape_markdown(data.get('phone', 'Не указан'))}\n"
-                f"Дата рождения: {data.get('birth_date', 'Не указана')}\n"
-                f"Пол: {data.get('gender', 'Не указан')}\n"
-                f"Ночлег в {room_number} доме."
-            )
-            qr = qrcode.make(registration_id)
-            img_byte_arr = io.BytesIO()
-            qr.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            retries = 3
-            for attempt in range(retries):
-                try:
-                    await query.message.reply_photo(
-                        photo=img_byte_arr,
-                        caption=response,
-                        parse_mode='Markdown',
-                        reply_markup=get_persistent_keyboard(user_id)
-                    )
-                    break
-                except Exception as e:
-                    logger.error(f"Error sending accommodation QR code (attempt {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        await notify_admin(context, f"Ошибка отправки QR-кода расселения после {retries} попыток: {e}")
-                        await query.message.reply_text(
-                            response,
-                            reply_markup=get_persistent_keyboard(user_id),
-                            parse_mode='Markdown'
-                        )
-            await query.message.reply_text(
-                "Теперь вы можете отменить расселение через основное меню.",
+            await send_qr_photo(
+                query.message,
+                registration_id,
+                caption=response,
+                parse_mode='HTML',
                 reply_markup=get_persistent_keyboard(user_id)
             )
-            logger.info(f"House {room_number} assigned to user_id={user_id}, user_room={user_room.get(user_id)}")
         except Exception as e:
-            logger.error(f"Error processing house selection: user_id={user_id}, data={data}, error={e}")
-            await notify_admin(context, f"Ошибка выбора дома user_id={user_id}: {e}")
-            await query.message.reply_text("Произошла ошибка при выборе дома. Попробуйте снова.", reply_markup=get_persistent_keyboard(user_id))
-        return ConversationHandler.END
-    elif data == 'cancel_accommodation_user':
-        logger.info(f"User cancelled accommodation: user_id={user_id}")
-        if user_id not in user_room or user_id not in registered_users:
-            await query.message.reply_text("Вы не расселены.", reply_markup=get_persistent_keyboard(user_id))
-            return ConversationHandler.END
-        registration_id = user_registration_ids.get(user_id)
-        if not registration_id:
-            await query.message.reply_text("Ошибка: регистрация не найдена.", reply_markup=get_persistent_keyboard(user_id))
-            return ConversationHandler.END
-        user_name = registrations[registration_id]['name']
-        room_number = user_room[user_id]
-        if user_name in room_assignments.get(room_number, []):
-            room_assignments[room_number].remove(user_name)
-        del user_room[user_id]
-        save_accommodations(context)
-        save_stats(context)
-        registrations[registration_id]['accommodation'] = 'Нет'
-        save_registrations(context)
-        await query.message.edit_text(
-            "Расселение отменено.",
+            await notify_admin(context, f"Ошибка отправки QR-кода расселения после всех попыток: {e}")
+            await query.message.reply_text(
+                response,
+                reply_markup=get_persistent_keyboard(user_id),
+                parse_mode='HTML'
+            )
+        await query.message.reply_text(
+            "Теперь вы можете отменить расселение через основное меню.",
             reply_markup=get_persistent_keyboard(user_id)
         )
-        logger.info(f"House assignment cancelled for user_id={user_id}, user_room={user_room.get(user_id, 'None')}")
+        logger.info(f"House {room_number} assigned to user_id={user_id}, user_room={user_room.get(user_id)}")
+    except Exception as e:
+        logger.error(f"Error processing house selection: user_id={user_id}, room={payload}, error={e}")
+        await notify_admin(context, f"Ошибка выбора дома user_id={user_id}: {e}")
+        await query.message.reply_text("Произошла ошибка при выборе дома. Попробуйте снова.", reply_markup=get_persistent_keyboard(user_id))
+    return ConversationHandler.END
+
+async def _cb_cancel_accommodation_user(user_id, query, context, payload):
+    logger.info(f"User cancelled accommodation: user_id={user_id}")
+    if user_id not in user_room or user_id not in registered_users:
+        await query.message.reply_text("Вы не расселены.", reply_markup=get_persistent_keyboard(user_id))
         return ConversationHandler.END
-    elif data == 'show_qr':
-        logger.info(f"User requested QR code: user_id={user_id}")
-        registration_id = user_registration_ids.get(user_id)
-        if registration_id:
-            qr = qrcode.make(registration_id)
-            img_byte_arr = io.BytesIO()
-            qr.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            retries = 3
-            for attempt in range(retries):
-                try:
-                    await query.message.reply_photo(
-                        photo=img_byte_arr,
-                        caption="Ваш QR-код для регистрации\nАдмин подтвердит вашу регистрацию после сканирования.",
-                        reply_markup=get_persistent_keyboard(user_id)
-                    )
-                    break
-                except Exception as e:
-                    logger.error(f"Error sending QR code (attempt {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        await notify_admin(context, f"Ошибка отправки QR-кода после {retries} попыток: {e}")
-                        await query.message.reply_text(
-                            "Не удалось отправить QR-код. Пожалуйста, попробуйте снова.",
-                            reply_markup=get_persistent_keyboard(user_id)
-                        )
-        else:
+    registration_id = user_registration_ids.get(user_id)
+    if not registration_id:
+        await query.message.reply_text("Ошибка: регистрация не найдена.", reply_markup=get_persistent_keyboard(user_id))
+        return ConversationHandler.END
+    user_name = registrations[registration_id]['name']
+    room_number = user_room[user_id]
+    room_assignments.get(room_number, set()).discard(user_name)
+    del user_room[user_id]
+    await save_accommodations(context)
+    save_stats(context)
+    registrations[registration_id]['accommodation'] = 'Нет'
+    await save_registrations(context)
+    await query.message.edit_text(
+        "Расселение отменено.",
+        reply_markup=get_persistent_keyboard(user_id)
+    )
+    logger.info(f"House assignment cancelled for user_id={user_id}, user_room={user_room.get(user_id, 'None')}")
+    return ConversationHandler.END
+
+async def _cb_show_qr(user_id, query, context, payload):
+    logger.info(f"User requested QR code: user_id={user_id}")
+    registration_id = user_registration_ids.get(user_id)
+    if registration_id:
+        try:
+            await send_qr_photo(
+                query.message,
+                registration_id,
+                caption="Ваш QR-код для регистрации\nАдмин подтвердит вашу регистрацию после сканирования.",
+                reply_markup=get_persistent_keyboard(user_id)
+            )
+        except Exception as e:
+            await notify_admin(context, f"Ошибка отправки QR-кода после всех попыток: {e}")
             await query.message.reply_text(
-                "QR-код недоступен. Пожалуйста, завершите регистрацию.",
+                "Не удалось отправить QR-код. Пожалуйста, попробуйте снова.",
                 reply_markup=get_persistent_keyboard(user_id)
             )
-        return ConversationHandler.END
+    else:
+        await query.message.reply_text(
+            "QR-код недоступен. Пожалуйста, завершите регистрацию.",
+            reply_markup=get_persistent_keyboard(user_id)
+        )
+    return ConversationHandler.END
+
+# Таблицы диспетчеризации callback-данных: поиск обработчика за O(1)
+# вместо цепочки сравнений строк на каждый callback
+CALLBACK_DISPATCH = {
+    'agree': _cb_agree,
+    'confirm_clear': _cb_confirm_clear,
+    'cancel_clear': _cb_cancel_clear,
+    'confirm_sleep': _cb_confirm_sleep,
+    'cancel_sleep': _cb_cancel_sleep,
+    'need_accommodation': _cb_need_accommodation,
+    'no_accommodation': _cb_no_accommodation,
+    'request_accommodation': _cb_request_accommodation,
+    'cancel_accommodation_user': _cb_cancel_accommodation_user,
+    'show_qr': _cb_show_qr,
+}
+
+CALLBACK_PREFIX_DISPATCH = {
+    'days_': _cb_days,
+    'date_': _cb_date,
+    'gender_': _cb_gender,
+    'room_': _cb_room,
+}
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    data = query.data
+    logger.debug("Callback query: user_id=%s, data=%s", user_id, data)
+    handler = CALLBACK_DISPATCH.get(data)
+    if handler is not None:
+        return await handler(user_id, query, context, data)
+    prefix, sep, payload = data.partition('_')
+    handler = CALLBACK_PREFIX_DISPATCH.get(prefix + sep)
+    if handler is not None:
+        return await handler(user_id, query, context, payload)
     logger.warning(f"Unhandled callback data: user_id={user_id}, data={data}")
     return ConversationHandler.END
 
@@ -1093,12 +1485,7 @@ async def name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Введите полное ФИО (например, Иванов Иван Иванович):")
         return NAME
     user_data[user_id] = {'name': name_text}
-    keyboard = [
-        [InlineKeyboardButton(f"{days} день: {days*10}$", callback_data=f'days_{days}') for days in [1, 2]],
-        [InlineKeyboardButton(f"{days} дня: {days*10}$", callback_data=f'days_{days}') for days in [3, 4]]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("На сколько дней вы приедете? Выберите вариант:", reply_markup=reply_markup)
+    await update.message.reply_text("На сколько дней вы приедете? Выберите вариант:", reply_markup=DAYS_KB)
     return DAYS
 
 async def city(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1123,7 +1510,7 @@ async def phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         phone_number = update.message.text.strip()
     logger.info(f"Received phone: user_id={user_id}, phone={phone_number}")
-    if not re.match(r"^\+?\d{10,15}$", phone_number):
+    if not _PHONE_MATCH(phone_number):
         await update.message.reply_text("Введите корректный номер телефона (например, +1234567890):")
         return PHONE
     user_data[user_id]['phone'] = phone_number
@@ -1134,24 +1521,19 @@ async def birth_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     birth_date_text = update.message.text.strip()
     logger.info(f"Received birth_date: user_id={user_id}, birth_date={birth_date_text}")
-    if not re.match(r"^\d{2}\.\d{2}\.\d{4}$", birth_date_text):
+    if not _BIRTH_DATE_MATCH(birth_date_text):
         await update.message.reply_text("Введите дату рождения в формате ДД.ММ.ГГГГ:")
         return BIRTH_DATE
     try:
-        day, month, year = map(int, birth_date_text.split('.'))
-        if not (1 <= day <= 31 and 1 <= month <= 12 and 1900 <= year <= 2025):
+        parsed = datetime.datetime.strptime(birth_date_text, '%d.%m.%Y')
+        if not 1900 <= parsed.year <= 2025:
             raise ValueError
     except ValueError:
         await update.message.reply_text("Некорректная дата рождения. Попробуйте снова:")
         return BIRTH_DATE
     user_data[user_id]['birth_date'] = birth_date_text
-    keyboard = [
-        [InlineKeyboardButton("Мужской", callback_data='gender_Мужской')],
-        [InlineKeyboardButton("Женский", callback_data='gender_Женский')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     try:
-        await update.message.reply_text("Выберите пол (нужно для расселения):", reply_markup=reply_markup)
+        await update.message.reply_text("Выберите пол (нужно для расселения):", reply_markup=GENDER_KB)
         logger.info(f"Gender selection keyboard sent to user_id={user_id}")
     except Exception as e:
         logger.error(f"Error sending gender selection keyboard to user_id={user_id}: {e}")
@@ -1176,165 +1558,120 @@ async def check_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Пример: /check_qr <ID>")
         return
-    registration_id = context.args[0]
+    # Дефисы отбрасываются: старые QR-коды содержат id в дефисной форме
+    registration_id = context.args[0].replace('-', '')
     if registration_id in registrations:
         data = registrations[registration_id]
-        user_id = next((uid for uid, rid in user_registration_ids.items() if rid == registration_id), None)
+        user_id = registration_user_ids.get(registration_id)
         accommodation_status = "Да" if user_id in user_room else "Нет"
         room_number = user_room.get(user_id, "Не выбрано")
         if accommodation_status == "Нет":
             accommodation_text = "Расселение: Не надо"
         else:
             accommodation_text = f"Расселение: {room_number} Дом"
-        response = (
-            "*Регистрация найдена!*\n"
-            f"ФИО: {escape_markdown(data['name'])}\n"
-            f"Количество дней: {data['days']}\n"
-            f"Дата приезда: {data['arrival_date']}\n"
-            f"Город: {escape_markdown(data['city'])}\n"
-            f"Ник: {escape_markdown(data.get('nick', 'Не указан'))}\n"
-            f"Телефон: {escape_markdown(data.get('phone', 'Не указан'))}\n"
-            f"Дата рождения: {data.get('birth_date', 'Не указана')}\n"
-            f"Пол: {data.get('gender', 'Не указан')}\n"
-            f"{accommodation_text}\n"
-            "Участник прошёл регистрацию."
-        )
-        retries = 3
-        for attempt in range(retries):
-            try:
-                records = worksheet.get_all_records()
-                row_idx = None
-                for idx, record in enumerate(records):
-                    if record['registration_id'] == registration_id:
-                        row_idx = idx + 2
-                        break
-                if row_idx:
-                    worksheet.format(f"A{row_idx}:K{row_idx}", {
-                        "backgroundColor": {
-                            "red": 0.678,
-                            "green": 1.0,
-                            "blue": 0.678
-                        }
-                    })
-                    logger.info(f"Row {row_idx} formatted to green for registration_id={registration_id}")
-                else:
-                    response += "\nОшибка: строка не найдена в таблице."
-                break
-            except Exception as e:
-                logger.error(f"Error formatting row in Google Sheets (attempt {attempt+1}/{retries}): {e}")
-                if attempt < retries - 1:
-                    await asyncio.sleep(2 * (2 ** attempt))
-                else:
-                    await notify_admin(context, f"Ошибка форматирования строки в Google Sheets после {retries} попыток: {e}")
-                    response += f"\nОшибка форматирования строки: {e}"
+        response = _registration_summary(
+            data, title="<b>Регистрация найдена!</b>",
+            footer=f"{accommodation_text}\nУчастник прошёл регистрацию.")
+        row_idx = rid_to_row.get(registration_id)
+        if row_idx:
+            # Строка уже зелёная (или формат в очереди) — повтор не нужен
+            if registration_id not in _greened_registrations:
+                _queue_row_green(row_idx)
+                _greened_registrations.add(registration_id)
+                logger.info(f"Row {row_idx} queued for green format, registration_id={registration_id}")
+        else:
+            response += "\nОшибка: строка не найдена в таблице."
     else:
         response = "Регистрация не найдена."
-    await update.message.reply_text(response, parse_mode='Markdown', reply_markup=admin_keyboard)
+    await update.message.reply_text(response, parse_mode='HTML', reply_markup=admin_keyboard)
 
 async def scan_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     if user_id not in admin_users:
-        await update.message.reply_text("Вы не администратор.")
+        # Обычные пользователи шлют фото не для сканирования — молча
+        # пропускаем, не запуская загрузку и декодер
+        logger.info(f"Photo from non-admin ignored: user_id={user_id}")
         return
-    photo = update.message.photo[-1]
+    # Варианты фото отсортированы по возрастанию размера; QR уверенно
+    # читается от ~600px, поэтому берём наименьший достаточный вариант
+    # вместо максимального (меньше байт на скачивание и пикселей декодеру)
+    photo_sizes = update.message.photo
+    photo = next((p for p in photo_sizes if max(p.width, p.height) >= 600), photo_sizes[-1])
     photo_file = await photo.get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
-    img = Image.open(io.BytesIO(photo_bytes))
-    decoded_objects = decode(img)
+    # download_to_memory пишет сразу в буфер, без промежуточного bytearray
+    # и его копии при заворачивании в BytesIO
+    photo_buf = io.BytesIO()
+    await photo_file.download_to_memory(photo_buf)
+    def _decode_grayscale():
+        # zbar нужна только яркость: конвертируем в 'L' и отдаём сырой
+        # буфер, не разворачивая полный RGB
+        photo_buf.seek(0)
+        img = Image.open(photo_buf)
+        # draft просит JPEG-декодер сразу отдать серое уменьшенное изображение
+        # (телефонные фото 2-4 Мп, QR уверенно читается и при ~1024px)
+        img.draft('L', (1024, 1024))
+        img = img.convert('L')
+        return decode((img.tobytes(), img.width, img.height))
+
+    decoded_objects = await asyncio.to_thread(_decode_grayscale)
     if decoded_objects:
-        registration_id = decoded_objects[0].data.decode('utf-8')
+        # Дефисы отбрасываются: старые QR-коды содержат id в дефисной форме
+        registration_id = decoded_objects[0].data.decode('utf-8').replace('-', '')
         if registration_id in registrations:
             data = registrations[registration_id]
-            user_id = next((uid for uid, rid in user_registration_ids.items() if rid == registration_id), None)
+            user_id = registration_user_ids.get(registration_id)
             accommodation_status = "Да" if user_id in user_room else "Нет"
             room_number = user_room.get(user_id, "Не выбрано")
             if accommodation_status == "Нет":
                 accommodation_text = "Расселение: Не надо"
             else:
                 accommodation_text = f"Расселение: {room_number} Дом"
-            stats['checked_in'].add(registration_id)
-            save_stats(context)
-            response = (
-                "*Регистрация найдена!*\n"
-                f"ФИО: {escape_markdown(data['name'])}\n"
-                f"Количество дней: {data['days']}\n"
-                f"Дата приезда: {data['arrival_date']}\n"
-                f"Город: {escape_markdown(data['city'])}\n"
-                f"Ник: {escape_markdown(data.get('nick', 'Не указан'))}\n"
-                f"Телефон: {escape_markdown(data.get('phone', 'Не указан'))}\n"
-                f"Дата рождения: {data.get('birth_date', 'Не указана')}\n"
-                f"Пол: {data.get('gender', 'Не указан')}\n"
-                f"{accommodation_text}\n"
-                "Участник прошёл регистрацию."
-            )
-            retries = 3
-            for attempt in range(retries):
-                try:
-                    records = worksheet.get_all_records()
-                    row_idx = None
-                    for idx, record in enumerate(records):
-                        if record['registration_id'] == registration_id:
-                            row_idx = idx + 2
-                            break
-                    if row_idx:
-                        worksheet.format(f"A{row_idx}:K{row_idx}", {
-                            "backgroundColor": {
-                                "red": 0.678,
-                                "green": 1.0,
-                                "blue": 0.678
-                            }
-                        })
-                        logger.info(f"Row {row_idx} formatted to green for registration_id={registration_id}")
-                    else:
-                        response += "\nОшибка: строка не найдена в таблице."
-                    break
-                except Exception as e:
-                    logger.error(f"Error formatting row in Google Sheets (attempt {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        await notify_admin(context, f"Ошибка форматирования строки в Google Sheets после {retries} попыток: {e}")
-                        response += f"\nОшибка форматирования строки: {e}"
-            channel_message = (
-                "*Новая регистрация!*\n"
-                f"ФИО: {escape_markdown(data['name'])}\n"
-                f"Кол-во дней: {data['days']}\n"
-                f"Дата приезда: {data['arrival_date']}\n"
-                f"Город: {escape_markdown(data['city'])}\n"
-                f"Ник: {escape_markdown(data.get('nick', 'Не указан'))}\n"
-                f"Телефон: {escape_markdown(data.get('phone', 'Не указан'))}\n"
-                f"Дата рождения: {data.get('birth_date', 'Не указана')}\n"
-                f"Пол: {data.get('gender', 'Не указан')}\n"
-                "Ждем вас на мероприятии!"
-            )
-            success = False
-            for attempt in range(retries):
-                try:
-                    can_send = await check_channel_permissions(context)
-                    if not can_send:
-                        logger.error(f"Бот не может отправить сообщение в канал {CHANNEL_ID}: отсутствуют права")
-                        await notify_admin(context, f"Бот не имеет прав для отправки сообщений в канал {CHANNEL_ID}. Пожалуйста, добавьте бота в канал и дайте права администратора.")
-                        break
-                    logger.info(f"Попытка отправки сообщения в канал {CHANNEL_ID} после сканирования QR (попытка {attempt+1}/{retries}): {channel_message}")
-                    await context.bot.send_message(chat_id=CHANNEL_ID, text=channel_message, parse_mode='Markdown')
-                    logger.info(f"Сообщение успешно отправлено в канал после сканирования QR: registration_id={registration_id}")
-                    success = True
-                    break
-                except Exception as e:
-                    logger.error(f"Ошибка отправки в канал после сканирования QR (попытка {attempt+1}/{retries}): {e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(2 * (2 ** attempt))
-                    else:
-                        logger.error(f"Не удалось отправить сообщение в канал после {retries} попыток: {e}")
-                        await notify_admin(context, f"Ошибка отправки в канал после сканирования QR после {retries} попыток: {e}")
+            # Повторное сканирование того же QR идемпотентно: строка уже
+            # зелёная и анонс уже ушёл, Sheets и канал не трогаем
+            already_checked_in = registration_id in stats['checked_in']
+            if not already_checked_in:
+                stats['checked_in'].add(registration_id)
+                save_stats(context)
+            response = _registration_summary(
+                data, title="<b>Регистрация найдена!</b>",
+                footer=f"{accommodation_text}\nУчастник прошёл регистрацию.")
+            row_idx = rid_to_row.get(registration_id)
+            if row_idx:
+                if registration_id not in _greened_registrations:
+                    _queue_row_green(row_idx)
+                    _greened_registrations.add(registration_id)
+                    logger.info(f"Row {row_idx} queued for green format, registration_id={registration_id}")
+            else:
+                response += "\nОшибка: строка не найдена в таблице."
+            if already_checked_in:
+                logger.info(f"Repeat scan for registration_id={registration_id}: format and channel post skipped")
+            else:
+                channel_message = _registration_summary(
+                    data, title="<b>Новая регистрация!</b>", days_label="Кол-во дней",
+                    footer="Ждем вас на мероприятии!")
+                # Ретраи, flood control и джиттер — внутри retry_with_backoff
+                # у _send_channel_message, как в _announce_registration
+                success = False
+                can_send = await check_channel_permissions(context)
+                if not can_send:
+                    logger.error(f"Бот не может отправить сообщение в канал {CHANNEL_ID}: отсутствуют права")
+                    await notify_admin(context, f"Бот не имеет прав для отправки сообщений в канал {CHANNEL_ID}. Пожалуйста, добавьте бота в канал и дайте права администратора.")
+                else:
+                    try:
+                        await _send_channel_message(context, channel_message, parse_mode='HTML')
+                        logger.info(f"Сообщение успешно отправлено в канал после сканирования QR: registration_id={registration_id}")
+                        success = True
+                    except Exception as e:
+                        logger.error(f"Не удалось отправить сообщение в канал после всех попыток: {e}")
+                        await notify_admin(context, f"Ошибка отправки в канал после сканирования QR после всех попыток: {e}")
                         response += f"\nОшибка отправки в канал: {e}"
-            if not success:
-                logger.warning(f"Сообщение не отправлено в канал после сканирования QR для registration_id={registration_id}")
+                if not success:
+                    logger.warning(f"Сообщение не отправлено в канал после сканирования QR для registration_id={registration_id}")
         else:
             response = "Регистрация не найдена."
     else:
         response = "Не удалось прочитать QR-код."
-    await update.message.reply_text(response, parse_mode='Markdown', reply_markup=admin_keyboard)
+    await update.message.reply_text(response, parse_mode='HTML', reply_markup=admin_keyboard)
 
 def update_accommodation_status(user_id, context=None):
     if worksheet is None:
@@ -1342,92 +1679,156 @@ def update_accommodation_status(user_id, context=None):
         if context:
             asyncio.create_task(notify_admin(context, "Google Sheets не инициализирован для обновления статуса"))
         return
-    retries = 3
-    for attempt in range(retries):
-        try:
-            records = worksheet.get_all_records()
-            for idx, record in enumerate(records):
-                if record['user_id'] == str(user_id):
-                    cell_list = worksheet.row_values(idx + 1)
-                    cell_list[-1] = "Да" if user_id in user_room else "Нет"
-                    worksheet.update(f'A{idx+1}', [cell_list])
-                    logger.info(f"Accommodation status updated for user_id={user_id}")
-                    return
-            logger.warning(f"User_id {user_id} not found in records for accommodation status update")
-            return
-        except Exception as e:
-            logger.error(f"Ошибка обновления статуса (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 * (2 ** attempt))
-            else:
-                logger.error("Не удалось обновить статус после всех попыток")
-                if context:
-                    asyncio.create_task(notify_admin(context, f"Ошибка обновления статуса user_id={user_id} после {retries} попыток: {e}"))
+    registration_id = user_registration_ids.get(user_id)
+    row_idx = rid_to_row.get(registration_id) if registration_id else None
+    if row_idx is None:
+        logger.warning(f"User_id {user_id} not found in records for accommodation status update")
+        return
+    status = "Да" if user_id in user_room else "Нет"
+    # Колонка K — accommodation; запись уходит батчем из _sheet_flush_loop
+    _queue_cell_update(f'K{row_idx}', status)
+    logger.info(f"Accommodation status queued for user_id={user_id}")
 
-# Инициализация приложения Telegram
-application = ApplicationBuilder().token(TOKEN).build()
+# Инициализация приложения Telegram.
+# Пул соединений и параллельная обработка апдейтов расширены, чтобы
+# рассылки через asyncio.gather не упирались в дефолтный пул httpx;
+# лимит семафора в рассылках (20) должен оставаться <= connection_pool_size.
+application = (
+    ApplicationBuilder()
+    .token(TOKEN)
+    .concurrent_updates(32)
+    .connection_pool_size(64)
+    .pool_timeout(30)
+    .connect_timeout(10)
+    .read_timeout(20)
+    .write_timeout(20)
+    # Токен-бакет PTB: глобальные ~28 msg/s (с запасом до лимита 30),
+    # пер-чатовые квоты и RetryAfter обрабатываются самим лимитером
+    .rate_limiter(AIORateLimiter(overall_max_rate=28, max_retries=3))
+    .build()
+)
+
+# Наборы подписей кнопок для текстовых фильтров; filters.Text строит
+# множество из переданного контейнера, поэтому держим его одним
+# frozenset на модуль. ADMIN_BUTTONS выводится из ADMIN_ROUTES ниже.
+PERSISTENT_BUTTONS = frozenset({
+    "Регистрация", "Расписание", "Спикеры", "Место проведения",
+    "Контакты", "QR Code", "Отменить расселение", "Расселить"
+})
+
+# Предкомпилированные шаблоны callback-данных для ConversationHandler;
+# PTB принимает готовые Pattern-объекты, так что компиляция и проверка
+# происходят без обращений в кэш re на каждом апдейте. room_ взят в
+# группу (?:[1-9]|10): в старой записи '^room_[1-9]|room_10$' из-за
+# приоритета | якорь ^ не действовал на ветку room_10
+CB_MAIN = re.compile(
+    '^(?:agree|show_qr|need_accommodation|no_accommodation|'
+    'request_accommodation|cancel_accommodation_user|'
+    'confirm_(?:clear|sleep)|cancel_(?:clear|sleep)|'
+    'gender_(?:Мужской|Женский)|room_(?:[1-9]|10))$'
+)
+CB_DAYS = re.compile('^days_[1-4]$')
+CB_DATE = re.compile('^date_0[3-6]\\.07\\.2025$')
+CB_GENDER = re.compile('^gender_(?:Мужской|Женский)$')
+CB_ROOM = re.compile('^room_(?:[1-9]|10)$')
+
+# Диалоговый обработчик собирается один раз при импорте: фильтры и
+# шаблоны внутри него не зависят от состояния приложения
+CONV_HANDLER = ConversationHandler(
+    entry_points=[
+        CallbackQueryHandler(button_callback, pattern=CB_MAIN),
+    ],
+    states={
+        NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, name)],
+        DAYS: [CallbackQueryHandler(button_callback, pattern=CB_DAYS)],
+        ARRIVAL_DATE: [CallbackQueryHandler(button_callback, pattern=CB_DATE)],
+        CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, city)],
+        PHONE: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, phone),
+            MessageHandler(filters.CONTACT, phone)
+        ],
+        BIRTH_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, birth_date)],
+        GENDER: [CallbackQueryHandler(button_callback, pattern=CB_GENDER)],
+        ROOM: [CallbackQueryHandler(button_callback, pattern=CB_ROOM)],
+    },
+    fallbacks=[CommandHandler('cancel', cancel)],
+)
 
 # Настройка обработчиков
 def setup_handlers(app):
-    conv_handler = ConversationHandler(
-        entry_points=[
-            CallbackQueryHandler(button_callback, pattern='^(agree|confirm_clear|cancel_clear|confirm_sleep|cancel_sleep|need_accommodation|no_accommodation|room_[1-9]|room_10|cancel_accommodation_user|request_accommodation|show_qr|gender_Мужской|gender_Женский)$'),
-        ],
-        states={
-            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, name)],
-            DAYS: [CallbackQueryHandler(button_callback, pattern='^days_[1-4]$')],
-            ARRIVAL_DATE: [CallbackQueryHandler(button_callback, pattern='^date_(03\\.07\\.2025|04\\.07\\.2025|05\\.07\\.2025|06\\.07\\.2025)$')],
-            CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, city)],
-            PHONE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, phone),
-                MessageHandler(filters.CONTACT, phone)
-            ],
-            BIRTH_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, birth_date)],
-            GENDER: [CallbackQueryHandler(button_callback, pattern='^gender_(Мужской|Женский)$')],
-            ROOM: [CallbackQueryHandler(button_callback, pattern='^room_[1-9]|room_10$')],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
-    )
-    admin_buttons = ["Статистика", "Очистить регистрации", "Разложить спать", "Выйти из админки"]
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_login))
-    app.add_handler(MessageHandler(filters.Text(admin_buttons) & ~filters.COMMAND, handle_admin_buttons))
-    app.add_handler(MessageHandler(filters.Text(["Регистрация", "Расписание", "Спикеры", "Место проведения", "Контакты", "QR Code", "Отменить расселение", "Расселить"]) & ~filters.COMMAND, handle_persistent_buttons))
-    app.add_handler(conv_handler)
+    # ~filters.COMMAND избыточен: ни одна подпись кнопки не начинается
+    # с '/', совпадение с множеством уже исключает команды
+    app.add_handler(MessageHandler(filters.Text(ADMIN_BUTTONS), handle_admin_buttons))
+    app.add_handler(MessageHandler(filters.Text(PERSISTENT_BUTTONS), handle_persistent_buttons))
+    app.add_handler(CONV_HANDLER)
     app.add_handler(CommandHandler("check_qr", check_qr))
-    app.add_handler(MessageHandler(filters.PHOTO, scan_qr))
+    # Фото обрабатываются только в личке: декодер QR не должен
+    # запускаться на каждое фото из групповых чатов
+    app.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, scan_qr))
+
+# Жизненный цикл приложения: современный lifespan-менеджер вместо
+# устаревших хуков on_event
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    setup_handlers(application)  # Настройка обработчиков
+    # Инициализация Google Sheets/данных и PTB-приложения независимы
+    # друг от друга — выполняем их сетевые запросы параллельно
+    await asyncio.gather(startup(), application.initialize())
+    # Общее состояние доступно обработчикам и через context.bot_data
+    # (PTB-идиоматичный путь); источником истины остаются Google Sheets
+    # и журнал статистики, поэтому PicklePersistence не подключается
+    application.bot_data.update({
+        'registrations': registrations,
+        'user_registration_ids': user_registration_ids,
+        'registration_user_ids': registration_user_ids,
+        'user_room': user_room,
+        'room_assignments': room_assignments,
+        'accommodation_initiated': accommodation_initiated,
+        'stats': stats
+    })
+    await application.start()
+    await set_webhook()
+    yield
+    # Остановка: досбрасываем отложенные записи и гасим PTB-приложение
+    if _stats_dirty.is_set():
+        await asyncio.to_thread(_write_stats_file)
+    if _regs_dirty.is_set() and worksheet is not None:
+        await asyncio.to_thread(_sync_save_registrations)
+    if _accom_dirty.is_set() and accommodation_worksheet is not None:
+        await asyncio.to_thread(_sync_save_accommodations)
+    # Точечные операции (зелёные строки, колонка K), не успевшие уйти
+    # батчем из _sheet_flush_loop, досылаются перед остановкой
+    if (_sheet_value_ops or _sheet_format_ops) and worksheet is not None:
+        value_ops, format_ops = _sheet_value_ops[:], _sheet_format_ops[:]
+        del _sheet_value_ops[:len(value_ops)]
+        del _sheet_format_ops[:len(format_ops)]
+        await asyncio.to_thread(_sync_flush_sheet_ops, value_ops, format_ops)
+    await application.stop()
+    await application.shutdown()
 
 # Инициализация FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Эндпоинт для Webhook
 @app.post("/webhook")
 async def webhook(request: Request):
-    update = await request.json()
+    # orjson разбирает тело быстрее стандартного json.loads из request.json()
+    update = orjson.loads(await request.body())
     update_obj = Update.de_json(update, application.bot)
-    await application.process_update(update_obj)
+    # Апдейт кладётся в очередь PTB: Telegram получает 200 сразу, а
+    # application.start() разбирает очередь с учётом лимита concurrent_updates
+    await application.update_queue.put(update_obj)
     return {"status": "ok"}
 
 # Функция для настройки Webhook
 async def set_webhook():
     webhook_url = f"{WEBHOOK_URL}/webhook"
     logger.info(f"Setting webhook to {webhook_url}")
-    await application.bot.setWebhook(webhook_url)
-
-# Инициализация при запуске
-@app.on_event("startup")
-async def on_startup():
-    await startup()  # Инициализация Google Sheets и данных
-    setup_handlers(application)  # Настройка обработчиков
-    await application.initialize()
-    await application.start()
-    await set_webhook()
-
-# Остановка при завершении
-@app.on_event("shutdown")
-async def on_shutdown():
-    await application.stop()
-    await application.shutdown()
+    # Подписываемся только на нужные типы апдейтов: Telegram не шлёт
+    # (а бот не разбирает) посты каналов, реакции, опросы и прочее
+    await application.bot.setWebhook(webhook_url, allowed_updates=['message', 'callback_query'])
 
 @app.get("/ping")
 async def ping():
@@ -1435,4 +1836,6 @@ async def ping():
     
 # Запуск приложения
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    # libuv-цикл вместо селекторного: меньше накладных расходов на
+    # каждый сокетный ввод-вывод вебхука и исходящих запросов к API
+    uvicorn.run(app, host="0.0.0.0", port=PORT, loop="uvloop")